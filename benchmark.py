@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+# https://github.com/lapsedordinary/rsscli/
+# Benchmarks for the hot paths of rsscli.py: updating (-u), starting the reader, finding tags (-f) and
+# creating the website (-w). Everything runs against a local fake feed server and a synthetic database in
+# a temporary home directory, so no network access is needed and your own database is never touched.
+import argparse
+import sys
+import os
+import os.path
+import sqlite3
+import random
+import time
+import json
+import pty
+import select
+import signal
+import shutil
+import tempfile
+import statistics
+import subprocess
+import threading
+import http.server
+
+parser = argparse.ArgumentParser(description='''Benchmark rsscli.py against a local fake feed server and a synthetic database''')
+parser.add_argument('--atom',help='fraction of feeds served as Atom rather than RSS',default=0.5,metavar='fraction')
+parser.add_argument('--errors',help='fraction of feeds that return a 500 error',default=0.02,metavar='fraction')
+parser.add_argument('--feeditems',help='number of items in every served feed',default=20,metavar='number')
+parser.add_argument('--itemwords',help='number of words in the description of every item',default=80,metavar='number')
+parser.add_argument('--items',help='number of items in the synthetic database',default=20000,metavar='number')
+parser.add_argument('--json',help='also write the results to this file, to compare between runs',metavar='file')
+parser.add_argument('--keep',help='don\'t remove the temporary directory with the database afterwards',action='store_true')
+parser.add_argument('--latency',help='seconds the fake server waits before answering',default=0.05,metavar='seconds')
+parser.add_argument('--redirects',help='fraction of feeds that permanently redirect (301) to another URL',default=0.05,metavar='fraction')
+parser.add_argument('--repeat',help='number of times to run the quick benchmarks (reader, find, website)',default=5,metavar='number')
+parser.add_argument('--rsscli',help='the script to benchmark',default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'rsscli.py'),metavar='file')
+parser.add_argument('--sources',help='number of sources in the synthetic database',default=200,metavar='number')
+parser.add_argument('--tags',help='number of distinct tags in the synthetic database',default=500,metavar='number')
+parser.add_argument('--threads',help='number of threads rsscli uses when updating',default=25,metavar='number')
+parser.add_argument('--tagged',help='fraction of items in the synthetic database that are tagged',default=0.1,metavar='fraction')
+parser.add_argument('--only',help='only run these benchmarks',choices=['update','reparse','reader','find','website'],nargs='+')
+args = parser.parse_args()
+
+words = ['security','malware','python','linux','feed','reader','network','patch','release','update','attack','research','vulnerability','cloud','browser','kernel','report','analysis','data','privacy']
+
+# the schema rsscli.py creates for a new database before upgrading it
+schema = [
+    '''CREATE TABLE source (url VARCHAR(1024) PRIMARY KEY NOT NULL, name VARCHAR(512), lastchecked INT DEFAULT 0, lastupdated INT DEFAULT 0, weight INT DEFAULT 5);''',
+    '''CREATE TABLE item (url VARCHAR(1024) PRIMARY KEY NOT NULL, source VARCHAR(1024) NOT NULL, time INT DEFAULT 0, readtime INT DEFAULT 0, addtime INT DEFAULT 0, title VARCHAR(300), author VARCHAR(256), description VARCHAR(4096) DEFAULT '', saved INT DEFAULT 0);''',
+    '''CREATE TABLE tag (tag VARCHAR(64) NOT NULL, url VARCHAR(1024) NOT NULL, FOREIGN KEY (url) REFERENCES item(url));''',
+]
+
+def sentence(rnd,n):
+    return ' '.join(rnd.choice(words) for i in range(n))
+
+def feedbehaviour(n):
+    # every feed behaves the same way on every request, so runs can be compared
+    rnd = random.Random(n)
+    return {
+        'atom' : rnd.random() < float(args.atom),
+        'error' : rnd.random() < float(args.errors),
+        'redirect' : rnd.random() < float(args.redirects),
+    }
+
+def feedxml(n,atom):
+    # a feed with --feeditems items; the newest item changes every minute, so updates find something new
+    rnd = random.Random(n)
+    now = int(time.time())
+    newest = now // 60
+    entries = []
+    for i in range(newest, newest - int(args.feeditems), -1):
+        link = 'http://example.com/%d/%d' % ( n, i )
+        title = sentence(rnd,8)
+        description = sentence(rnd,int(args.itemwords))
+        itemtime = i * 60
+        if atom:
+            entries.append('<entry><title>%s</title><link href="%s"/><id>%s</id><updated>%s</updated><author><name>Author %d</name></author><summary>%s</summary></entry>' % ( title, link, link, time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(itemtime)), n, description ) )
+        else:
+            entries.append('<item><title>%s</title><link>%s</link><guid>%s</guid><pubDate>%s</pubDate><author>author%d@example.com (Author %d)</author><description>%s</description></item>' % ( title, link, link, time.strftime('%a, %d %b %Y %H:%M:%S GMT',time.gmtime(itemtime)), n, n, description ) )
+    if atom:
+        return('<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed %d</title><id>urn:feed:%d</id><updated>%s</updated>%s</feed>' % ( n, n, time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(now)), ''.join(entries) ) ).encode('utf-8')
+    return('<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel><title>Feed %d</title><link>http://example.com/%d</link><description>Feed %d</description>%s</channel></rss>' % ( n, n, n, ''.join(entries) ) ).encode('utf-8')
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    # serves /feed/<n>.xml, and /moved/<n>.xml for feeds that redirect
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(float(args.latency))
+        parts = self.path.strip('/').split('/')
+        try:
+            n = int(parts[1].split('.')[0])
+        except (IndexError, ValueError):
+            return(self.answer(404,b'not found'))
+        behaviour = feedbehaviour(n)
+        if behaviour['error']:
+            return(self.answer(500,b'error'))
+        if behaviour['redirect'] and parts[0] == 'feed':
+            return(self.answer(301,b'',{'Location' : '/moved/%d.xml' % n}))
+        content = feedxml(n,behaviour['atom'])
+        self.answer(200,content,{'Content-Type' : 'application/atom+xml' if behaviour['atom'] else 'application/rss+xml'})
+
+    def answer(self,status,content,headers={}):
+        self.send_response(status)
+        for h in headers:
+            self.send_header(h,headers[h])
+        self.send_header('Content-Length',str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self,format,*args):
+        pass
+
+def startserver():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1',0),FeedHandler)
+    server.daemon_threads = True
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return(server)
+
+def makedb(home,port):
+    # a database with --sources sources on the fake server, --items items and --tags tags
+    rnd = random.Random(0)
+    os.makedirs(os.path.join(home,'.rsscli'))
+    conn = sqlite3.connect(os.path.join(home,'.rsscli','database.db'))
+    cur = conn.cursor()
+    for s in schema:
+        cur.execute(s)
+    now = int(time.time())
+    sources = int(args.sources)
+    cur.executemany('INSERT INTO source (url, name, lastchecked, lastupdated, weight) VALUES (?, ?, 0, ?, ?)', [ ( 'http://127.0.0.1:%d/feed/%d.xml' % ( port, n ), 'Feed %d' % n, now - rnd.randint(0,86400), rnd.randint(1,9) ) for n in range(sources) ] )
+    items = []
+    tags = []
+    tagnames = [ '%s%d' % ( rnd.choice(words), t ) for t in range(int(args.tags)) ]
+    for i in range(int(args.items)):
+        n = rnd.randrange(sources)
+        url = 'http://example.com/old/%d/%d' % ( n, i )
+        read = rnd.random() < 0.5
+        items.append( ( url, 'http://127.0.0.1:%d/feed/%d.xml' % ( port, n ), now - rnd.randint(0,30*86400), now - rnd.randint(0,86400) if read else 0, now, sentence(rnd,8), 'Author %d' % n, sentence(rnd,int(args.itemwords)), 1 if rnd.random() < 0.02 else 0 ) )
+        if rnd.random() < float(args.tagged):
+            for t in set(rnd.choice(tagnames) for x in range(rnd.randint(1,4))):
+                tags.append( ( t, url ) )
+    cur.executemany('INSERT INTO item (url, source, time, readtime, addtime, title, author, description, saved) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', items)
+    cur.executemany('INSERT INTO tag (tag, url) VALUES (?, ?)', tags)
+    conn.commit()
+    # the most used tag, which is what we look up with -f
+    cur.execute('SELECT tag FROM tag GROUP BY tag ORDER BY count(*) DESC LIMIT 1')
+    one = cur.fetchone()
+    conn.close()
+    return(one[0] if one else 'none')
+
+def run(home,*options):
+    # runs rsscli.py with the given options and returns the number of seconds it took
+    env = dict(os.environ, HOME=home)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, args.rsscli, '-F', '-b'] + list(options), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, check=True)
+    return(time.perf_counter() - start)
+
+def runreader(home):
+    # the reader needs a terminal, so we give it one; it is ready once it has printed the number of entries
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.environ['HOME'] = home
+        os.execv(sys.executable, [sys.executable, args.rsscli, '-F', '-b'])
+    output = b''
+    elapsed = None
+    while elapsed is None:
+        ready, x, y = select.select([fd],[],[],60)
+        if not ready:
+            break
+        try:
+            data = os.read(fd,4096)
+        except OSError:
+            break
+        if not data:
+            break
+        output += data
+        if b' entries' in output:
+            elapsed = time.perf_counter() - start
+    try:
+        os.write(fd,b'q')
+        time.sleep(.1)
+        os.kill(pid,signal.SIGTERM)
+    except OSError:
+        pass
+    os.waitpid(pid,0)
+    os.close(fd)
+    if elapsed is None:
+        raise RuntimeError('the reader did not start: %s' % output.decode('utf-8','replace'))
+    return(elapsed)
+
+def summary(name,times,unit=None,count=0):
+    result = { 'benchmark' : name, 'runs' : len(times), 'median' : statistics.median(times), 'min' : min(times), 'max' : max(times) }
+    line = '%-10s median %8.3fs  min %8.3fs  max %8.3fs' % ( name, result['median'], result['min'], result['max'] )
+    if unit:
+        result[unit + '/s'] = count / result['median']
+        line += '  %10.1f %s/s' % ( result[unit + '/s'], unit )
+    print(line)
+    return(result)
+
+server = startserver()
+port = server.server_address[1]
+home = tempfile.mkdtemp(prefix='rsscli-benchmark-')
+results = []
+try:
+    findtag = makedb(home,port)
+    # the first run upgrades the database to the current schema, which we don't want to measure
+    run(home,'-S')
+    print('Synthetic database with %s sources, %s items and %s tags in %s' % ( args.sources, args.items, args.tags, home ) )
+    benchmarks = args.only or ['reader','find','website','update','reparse']
+    repeat = int(args.repeat)
+    if 'reader' in benchmarks:
+        results.append(summary('reader',[ runreader(home) for i in range(repeat) ]))
+    if 'find' in benchmarks:
+        results.append(summary('find',[ run(home,'-f',findtag) for i in range(repeat) ]))
+    if 'website' in benchmarks:
+        results.append(summary('website',[ run(home,'-w',os.path.join(home,'website.html')) for i in range(repeat) ]))
+    if 'update' in benchmarks or 'reparse' in benchmarks:
+        # the update changes the database, so this runs late and only once; it keeps the responses for reparse
+        seconds = run(home,'-u','--rawcache','--threads',str(args.threads))
+        if 'update' in benchmarks:
+            results.append(summary('update',[ seconds ],'sources',int(args.sources)))
+    if 'reparse' in benchmarks:
+        # the ingest of the same responses again, read from the disk rather than the network
+        results.append(summary('reparse',[ run(home,'--reparse') for i in range(repeat) ],'sources',int(args.sources)))
+finally:
+    server.shutdown()
+    if args.keep:
+        print('Kept %s' % home)
+    else:
+        shutil.rmtree(home)
+
+if args.json:
+    with open(args.json,'w') as f:
+        json.dump({ 'time' : int(time.time()), 'options' : vars(args), 'results' : results }, f, indent=1)
@@ -1,5 +1,7 @@
 #!/usr/bin/python3
 # https://github.com/lapsedordinary/rsscli/
+import time
+starttime = time.perf_counter() # for the startup time printed by --profile
 import argparse
 import sys
 import os
@@ -11,12 +13,31 @@ import requests
 import feedparser
 import urllib.parse
 from bs4 import BeautifulSoup as bs4
-import time
 import datetime
 import csv
+import collections
+import io
+import json
 import webbrowser
 import threading
+import queue
+import zlib
+import hashlib
+import random
+import struct
+import tempfile
+import gzip
+import html
+import socket
+import asyncio
+import subprocess
 import logging
+import multiprocessing
+import concurrent.futures
+import atexit
+import contextlib
+import cProfile
+import pstats
 import pyperclip
 from tendo import singleton
 
@@ -30,6 +51,13 @@ except:
 configdir = os.path.expanduser('~/.rsscli/')
 dbfile = configdir + 'database.db'
 
+def datestamp(date):
+    # for --since and --until: the timestamp of the start of the day in YYYY-MM-DD
+    try:
+        return(int(time.mktime(time.strptime(date,'%Y-%m-%d'))))
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a date in the form YYYY-MM-DD" % date)
+
 # checking the arguments
 # this also serves as the help when the tool is invoked with the -h option
 parser = argparse.ArgumentParser(description='''TODO''')
@@ -39,35 +67,55 @@ parser.add_argument('--addcsv',help='add URLs to the reader from a CSV file with
 parser.add_argument('-b','--blackwhite',help='don\'t use terminal colours',default=0,metavar='',const='xxx',nargs='?')
 parser.add_argument('-c','--recent',help='display items recently marked as read (default 10, but can be changed with -n)',default=0,const='xxx',nargs='?')
 parser.add_argument('-C','--recentsaved',help='display items recently tagged (default 10, but can be changed with -n)',default=0,const='xxx',nargs='?')
+parser.add_argument('--cachedays',help='number of days to keep articles fetched by --prefetch',default=30,metavar='days')
+parser.add_argument('--cachesize',help='number of megabytes the articles fetched by --prefetch may take up in the database; the oldest are removed first',default=50,metavar='MB')
 parser.add_argument('--checkfrequency',help='set the number of seconds before a feed is checked again (only makes sense when combined with -u)',default=900,metavar='seconds')
 parser.add_argument('--delete',help='delete source URLs from the reader', metavar='URL',default='',nargs='+')
+parser.add_argument('--export',help='write the items, with their tags and source, to this file (- for standard output); CSV if the file name ends in .csv, JSON Lines otherwise. Can be narrowed down with --state, -s, -f (or -f with -O), -i, -m, --since, --until and -n',metavar='file')
 parser.add_argument('-e','--reverse',help='show items or sources in reverse',default=0,const='xxx',nargs='?')
 parser.add_argument('-f','--find',help='find items exactly matching all tags',metavar='TAG',nargs='+')
 parser.add_argument('-F','--force',help='run even when another instance is running', metavar='',default='',const='xxx',nargs='?')
 parser.add_argument('-g','--renametag',help='rename a tag', metavar=('oldtag','newtag'),nargs=2)
 parser.add_argument('--logfile',help='file to print logs to (by default logs are printed to standard output). Implies -b',default=0,metavar='',const='xxx',nargs='?')
+parser.add_argument('--historydays',help='number of days of update statistics to keep in the database (only makes sense when combined with -u)',default=30,metavar='days')
 parser.add_argument('-i','--min',help='minimum weight of sources to consider',default=1,metavar='weight')
 parser.add_argument('--insecure',help='ignore ceritifcate valudation (experimental)',action='store_true')
 parser.add_argument('-j','--adjustweight',help='adjust the weight of this source', metavar=('URL','weight'),nargs=2)
 parser.add_argument('-l','--list',help='list all source URLs', metavar='',default='',const='xxx',nargs='?')
+parser.add_argument('--merge',help='merge another rsscli database into this one, in one transaction: sources and items it has that we don\'t are added, and where both have an item, the read state and tags of the copy read last win (for a source, the copy checked last); an item saved in either is saved. Merge both ways to sync two databases',metavar='file')
 parser.add_argument('-m','--max',help='maximum weight of sources to consider',default=9,metavar='weight')
 parser.add_argument('-n','--limit',help='limit the number of entries to display',default=0,metavar='number')
 parser.add_argument('-o','--shortfind',help='when used with find, do not display tags and list date in short form first', metavar='',default=0,const='xxx',nargs='?')
+parser.add_argument('--pager',help='show what -l, -t, -f, -c and -C list in this pager (default $PAGER, or less -R) when it goes to the terminal',metavar='command',const=os.environ.get('PAGER') or 'less -R',nargs='?')
+parser.add_argument('--parsers',help='number of processes that parse feeds when checking for updates (default: the number of CPUs); 0 parses them in the checking threads',default=os.cpu_count() or 1,metavar='number')
+parser.add_argument('--prefetch',help='fetch the full text of this many of the next unread items (default 50), after checking for updates with -u or in the background while reading, so s shows it without waiting for the web site, even offline',default=0,type=int,metavar='number',const=50,nargs='?')
+parser.add_argument('--profile',help='profile the command and write the statistics to this file (default rsscli.prof); the slowest functions and the time spent in every phase are printed when the program ends',metavar='file',const='rsscli.prof',nargs='?')
 parser.add_argument('-O','--orfind',help='when used with find, use OR rather than AND', metavar='',default=0,const='xxx',nargs='?')
+parser.add_argument('--rank',help='in the reader, show the items that matter first: an item counts as this many hours (default 24) newer for every point of weight of its source',default=0,type=int,metavar='hours',const=24,nargs='?')
+parser.add_argument('--rawcache',help='when used with -u, keep the last response of every source, compressed, in at most this many megabytes (default 100), for --reparse',default=0,type=int,metavar='MB',const=100,nargs='?')
+parser.add_argument('--reparse',help='build the items again from the responses kept by --rawcache, without going on the network; items we already have get the title, author and summary found now', metavar='',default='',const='xxx',nargs='?')
 parser.add_argument('-r','--renamefeed',help='rename this source', metavar=('URL','name'),nargs=2)
 parser.add_argument('--read',help='mark entry as read', metavar='URL', nargs='+')
 parser.add_argument('-R','--readonly',help='open database in read-only mode (will cause errors when trying to write!)',action='store_true')
+parser.add_argument('--report',help='write timings and counts for every source checked to this file; JSON if the file name ends in .json, CSV otherwise (only makes sense when combined with -u)',metavar='file')
 parser.add_argument('-s','--saved',help='show saved (bookmarked) items', metavar='',default='',const='xxx',nargs='?')
+parser.add_argument('--saveview',help='save -i, -m, -s, -e and --rank under this name, to use them again with --view',metavar='name')
+parser.add_argument('--sample',help='when used with --profile, sample the stacks of all threads every this many seconds (default 0.005) and write them in the folded format used by flame graph tools',metavar='seconds',type=float,const=0.005,nargs='?')
 parser.add_argument('--save',help='save entry', metavar='URL', nargs='+')
 parser.add_argument('-S','--statistics',help='show usage statistics', metavar='',default='',const='xxx',nargs='?')
-parser.add_argument('-t','--listtags',help='list all tags, can be limited by -n',default=0,metavar='',const='xxx',nargs='?')
-parser.add_argument('--tempimport',help='add URLs to the reader from a CSV file; the second optional argument is the weight', metavar='file')
+parser.add_argument('--serve',help='serve the website with the unread items, and the saved ones under /saved, a page of -n items (default 50) at a time, on this port (default 8080) of this computer; the save and delete buttons work, and /api/save, /api/markread and /api/tag do the same for other programs',type=int,metavar='port',const=8080,nargs='?')
+parser.add_argument('--since',help='when used with -t or --export, only count items from this date (YYYY-MM-DD) on',type=datestamp,metavar='date')
+parser.add_argument('-t','--listtags',help='list all tags, or those starting with prefix, can be limited by -n, --since and --until',metavar='prefix',const='',nargs='?')
 parser.add_argument('--threads',help='number of parallel threads when checking for updates',default=25,metavar='number')
 parser.add_argument('-u','--update',help='read new entries from sources', metavar='',const='xxx',default='',nargs='?')
+parser.add_argument('--state',help='when used with --export, only write the items that are read or unread',choices=['read','unread'])
+parser.add_argument('--until',help='when used with -t or --export, only count items from before this date (YYYY-MM-DD)',type=datestamp,metavar='date')
 parser.add_argument('-U','--unread',help='mark entry as unread', metavar='URL', nargs='+')
 parser.add_argument('-v','--verbose',help='print more verbose statements', metavar='',default=1,const='xxx',nargs='?')
 parser.add_argument('-vv','--veryverbose',help='print even more verbose statements', metavar='',default=0,const='xxx',nargs='?')
 parser.add_argument('-vvv','--veryveryverbose',help='print most verbose statements', metavar='',default=0,const='xxx',nargs='?')
+parser.add_argument('--worker',help='check the sources that are due, like -u, alongside other workers: every worker claims --threads sources at a time, so no source is checked twice. Without seconds the worker stops when no source is due; with seconds it waits that long and looks again',type=int,metavar='seconds',const=0,nargs='?')
+parser.add_argument('--view',help='read with the options saved under this name by --saveview; without a name, list the saved views',metavar='name',const='',nargs='?')
 parser.add_argument('-w','--website',help='create website with saved items',metavar='FILENAME',nargs='+')
 parser.add_argument('-x','--copyurl',help='copy the url at the given line number, to combine with -z', metavar='number',default=1)
 parser.add_argument('-z','--linenumber',help='print line numbers, to combine with -x', metavar='',default=0,const='xxx',nargs='?')
@@ -84,8 +132,79 @@ if args.veryverbose: loglevel=logging.INFO
 if args.veryveryverbose: loglevel=logging.DEBUG
 logging.basicConfig(level=loglevel,filename=args.logfile,format='%(asctime)s %(levelname)s: %(message)s')
 
-# We don't want to run multiple instances of the program in parallel, because this causes database lock issues
-if not args.force and not args.readonly:
+# wall-clock seconds spent in every phase of the program; time spent in a phase inside another phase
+# only counts towards the inner one. Every thread has its own stack of the phases it is in, and the lock
+# keeps the threads from adding to the totals at the same time
+phasetimes = { 'startup' : time.perf_counter() - starttime }
+phaselocal = threading.local()
+phaselock = threading.Lock()
+
+@contextlib.contextmanager
+def phase(name):
+    if not hasattr(phaselocal,'stack'):
+        phaselocal.stack = []
+    phasestack = phaselocal.stack
+    start = time.perf_counter()
+    phasestack.append(0.0)
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        inner = phasestack.pop()
+        if phasestack: phasestack[-1] += elapsed
+        with phaselock:
+            phasetimes[name] = phasetimes.get(name,0.0) + elapsed - inner
+
+def sampler(interval,samples,stop):
+    # a poor man's sampling profiler: every interval seconds we record the stack of every other thread
+    me = threading.get_ident()
+    while not stop.wait(interval):
+        for ident, frame in sys._current_frames().items():
+            if ident == me: continue
+            stack = []
+            while frame:
+                stack.append('%s (%s:%d)' % ( frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_code.co_firstlineno ))
+                frame = frame.f_back
+            folded = ';'.join(reversed(stack))
+            samples[folded] = samples.get(folded,0) + 1
+
+def stopprofile(profiler,sampling):
+    # called when the program exits, including through quit()
+    phasetimes['total'] = time.perf_counter() - starttime
+    if sampling:
+        samplerthread, samples, stop = sampling
+        stop.set()
+        samplerthread.join()
+        with open(args.profile,'w') as f:
+            for stack in sorted(samples, key=lambda x: samples[x], reverse=True):
+                f.write('%s %d\n' % ( stack, samples[stack] ))
+        sys.stderr.write('Wrote %d samples to %s\n' % ( sum(samples.values()), args.profile ))
+    else:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler,stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+        sys.stderr.write('Wrote profile to %s\n' % args.profile)
+    for name in phasetimes:
+        sys.stderr.write('%-10s %8.3fs\n' % ( name, phasetimes[name] ))
+
+if args.profile:
+    profiler = None
+    sampling = None
+    if args.sample:
+        samples = {}
+        stop = threading.Event()
+        samplerthread = threading.Thread(target=sampler,args=(args.sample,samples,stop))
+        samplerthread.daemon = True
+        samplerthread.start()
+        sampling = ( samplerthread, samples, stop )
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(stopprofile,profiler,sampling)
+
+# We don't want to run multiple instances of the program in parallel, because this causes database lock issues.
+# --worker and --serve are meant to run alongside the others, with their own connections to the database
+if not args.force and not args.readonly and args.worker is None and args.serve is None:
     try:
         me = singleton.SingleInstance()
     except:
@@ -108,23 +227,223 @@ shortfind = args.shortfind
 
 limit = int(args.limit)
 
+# the lines the listing commands print are gathered by myprint and written outputbatch at a time, to the terminal
+# or through --pager, rather than with a write for every line; outputlines is None outside these commands
+outputbatch = 1000
+outputlines = None
+output = sys.stdout
+copyline = int(args.copyurl) if args.linenumber else 0
+
 def myprint(text):
     # this allows us to print line numbers and, if needed, copy the URL in a specific line number
     global linenumber 
     linenumber = linenumber + 1
     if (args.linenumber):
-        print( str(linenumber) + '. ' + text )
-        if (int(args.copyurl) == linenumber):
+        if linenumber == copyline:
+            # only the line asked for is looked at for a URL
             urls = re.findall('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),~#]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', text)
             if urls and urls[0]:
                 if urls[0][-1:] == ')': urls[0] = urls[0][:-1]
                 pyperclip.copy(urls[0])   
+        text = str(linenumber) + '. ' + text
+    if outputlines is None:
+        with phase('render'):
+            print( text )
     else:
-        print( text )
+        outputlines.append(text)
+        if len(outputlines) >= outputbatch: flushoutput()
+
+def flushoutput():
+    with phase('render'):
+        try:
+            output.write('\n'.join(outputlines) + '\n')
+            output.flush()
+        except BrokenPipeError:
+            # the pager or the program we're piped into has stopped reading, so there's no point in going on;
+            # standard output goes nowhere, so Python doesn't complain again when it flushes it at exit
+            outputlines.clear()
+            os.dup2(os.open(os.devnull,os.O_WRONLY),sys.stdout.fileno())
+            quit()
+        outputlines.clear()
+
+@contextlib.contextmanager
+def listing():
+    # the output of a listing command
+    global outputlines, output
+    pager = None
+    if args.pager and sys.stdout.isatty():
+        pager = subprocess.Popen(args.pager, shell=True, stdin=subprocess.PIPE, text=True, encoding=sys.stdout.encoding, errors='replace')
+        output = pager.stdin
+    outputlines = []
+    try:
+        yield
+    finally:
+        if outputlines: flushoutput()
+        outputlines = None
+        if pager:
+            try:
+                pager.stdin.close()
+            except BrokenPipeError:
+                pass
+            pager.wait()
+            output = sys.stdout
+
+# an item as we use it when reading feeds, in the reader and for the website. For a feed entry the source is
+# the feed URL, for an item from the database it's the name of the source. A namedtuple has no dictionary
+# per instance, which matters with tens of thousands of unread items. In the reader and on the website an item
+# stands for its whole cluster of near-duplicates; others holds the URLs of the rest
+Item = collections.namedtuple('Item', ['url', 'source', 'time', 'title', 'author', 'content', 'weight', 'others'], defaults=[()])
 
 # it may be that some RSS feeds like to pretend we're a normal browser
 feedparser.USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0"
 
+# query parameters that only say where a link was clicked, so the same story linked from different places has
+# different URLs
+trackingparams = re.compile(r'^(utm_.*|fbclid|gclid|dclid|msclkid|yclid|mc_cid|mc_eid|_hsenc|_hsmi|igshid|ref_src|ncid|cmpid|xtor)$', re.I)
+
+def canonicalurl(url):
+    # the form of a URL that the variants of it linking to the same item have in common: without tracking
+    # parameters, nor a fragment made of them only, with the scheme and host in lower case, without user name,
+    # password and default port, and without a slash at the end of the path. Other fragments are kept, as they
+    # may be all that tells two items apart, e.g. page#v1.2 and page#v1.3 or a #!/ path
+    try:
+        parts = urllib.parse.urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        if scheme not in ( 'http', 'https' ) or not parts.hostname:
+            return(url)
+        netloc = parts.hostname if not ':' in parts.hostname else '[' + parts.hostname + ']'
+        if parts.port and parts.port != ( 80 if scheme == 'http' else 443 ):
+            netloc += ':%d' % parts.port
+    except ValueError:
+        return(url)
+    path = parts.path.rstrip('/') or '/'
+    query = '&'.join( p for p in parts.query.split('&') if p and not trackingparams.match(p.split('=',1)[0]) )
+    fragment = parts.fragment if any( p and not trackingparams.match(p.split('=',1)[0]) for p in parts.fragment.split('&') ) else ''
+    return(urllib.parse.urlunsplit( ( scheme, netloc, path, query, fragment ) ))
+
+def urlkey(url):
+    # the key of an item in item.urlkey, by which we know we already have it: the canonical URL without the
+    # scheme, as many sites serve the same page over http and https. The item keeps the link of its feed, which
+    # is what we open
+    return(canonicalurl(url).split('://',1)[-1])
+
+def addurlkeys(cur):
+    # every item gets the urlkey of its link
+    cur.execute('ALTER TABLE item ADD COLUMN urlkey VARCHAR(1024)')
+    cur.execute('SELECT id, url FROM item')
+    cur.executemany('UPDATE item SET urlkey = ? WHERE id = ?', [ ( urlkey(url), itemid ) for itemid, url in cur.fetchall() ])
+    cur.execute('CREATE INDEX item_urlkey ON item (urlkey)')
+
+# the steps that bring the database from one version to the next, as SQL or as a function that is given a
+# cursor; PRAGMA user_version holds the version a database is at. A new database is created the way it was at
+# version 0 and then taken through every step
+migrations = [
+# 1: integer ids for sources, items and tags, so items and tags refer to them by number rather than by URL
+'''
+CREATE TABLE IF NOT EXISTS fetchlog (url VARCHAR(1024) NOT NULL, time INT DEFAULT 0, status INT DEFAULT 0, connecttime REAL, downloadtime REAL, parsetime REAL, dbtime REAL, bytes INT DEFAULT 0, new INT DEFAULT 0, updated INT DEFAULT 0);
+ALTER TABLE source RENAME TO oldsource;
+ALTER TABLE item RENAME TO olditem;
+ALTER TABLE tag RENAME TO oldtag;
+ALTER TABLE fetchlog RENAME TO oldfetchlog;
+CREATE TABLE source (id INTEGER PRIMARY KEY, url VARCHAR(1024) UNIQUE NOT NULL, name VARCHAR(512), lastchecked INT DEFAULT 0, lastupdated INT DEFAULT 0, weight INT DEFAULT 5);
+CREATE TABLE item (id INTEGER PRIMARY KEY, url VARCHAR(1024) UNIQUE NOT NULL, sourceid INT REFERENCES source(id), time INT DEFAULT 0, readtime INT DEFAULT 0, addtime INT DEFAULT 0, title VARCHAR(300), author VARCHAR(256), description VARCHAR(4096) DEFAULT '', saved INT DEFAULT 0);
+CREATE INDEX item_sourceid ON item (sourceid);
+CREATE TABLE tag (id INTEGER PRIMARY KEY, tag VARCHAR(64) UNIQUE NOT NULL);
+CREATE TABLE itemtag (tagid INT NOT NULL REFERENCES tag(id), itemid INT NOT NULL REFERENCES item(id), PRIMARY KEY (tagid, itemid));
+CREATE INDEX itemtag_itemid ON itemtag (itemid);
+CREATE TABLE fetchlog (sourceid INT NOT NULL REFERENCES source(id), time INT DEFAULT 0, status INT DEFAULT 0, connecttime REAL, downloadtime REAL, parsetime REAL, dbtime REAL, bytes INT DEFAULT 0, new INT DEFAULT 0, updated INT DEFAULT 0);
+INSERT INTO source (url, name, lastchecked, lastupdated, weight) SELECT url, name, lastchecked, lastupdated, weight FROM oldsource ORDER BY rowid;
+INSERT INTO item (url, sourceid, time, readtime, addtime, title, author, description, saved) SELECT olditem.url, source.id, olditem.time, olditem.readtime, olditem.addtime, olditem.title, olditem.author, olditem.description, olditem.saved FROM olditem LEFT JOIN source ON source.url = olditem.source ORDER BY olditem.rowid;
+INSERT INTO tag (tag) SELECT tag FROM oldtag GROUP BY tag ORDER BY min(rowid);
+INSERT OR IGNORE INTO itemtag (tagid, itemid) SELECT tag.id, item.id FROM oldtag JOIN tag ON tag.tag = oldtag.tag JOIN item ON item.url = oldtag.url ORDER BY oldtag.rowid;
+INSERT INTO fetchlog (sourceid, time, status, connecttime, downloadtime, parsetime, dbtime, bytes, new, updated) SELECT source.id, oldfetchlog.time, oldfetchlog.status, oldfetchlog.connecttime, oldfetchlog.downloadtime, oldfetchlog.parsetime, oldfetchlog.dbtime, oldfetchlog.bytes, oldfetchlog.new, oldfetchlog.updated FROM oldfetchlog JOIN source ON source.url = oldfetchlog.url;
+DROP TABLE oldtag;
+DROP TABLE olditem;
+DROP TABLE oldsource;
+DROP TABLE oldfetchlog;
+''',
+# 2: the number of items with every tag, kept up to date by triggers, so listing tags doesn't count them all
+'''
+CREATE TABLE tagcount (tagid INTEGER PRIMARY KEY REFERENCES tag(id), count INT NOT NULL DEFAULT 0);
+CREATE INDEX tagcount_count ON tagcount (count);
+INSERT INTO tagcount (tagid, count) SELECT tagid, count(*) FROM itemtag GROUP BY tagid;
+CREATE TRIGGER itemtag_insert AFTER INSERT ON itemtag BEGIN
+    INSERT INTO tagcount (tagid, count) VALUES (new.tagid, 1) ON CONFLICT (tagid) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER itemtag_delete AFTER DELETE ON itemtag BEGIN
+    UPDATE tagcount SET count = count - 1 WHERE tagid = old.tagid;
+END;
+CREATE TRIGGER tag_delete AFTER DELETE ON tag BEGIN
+    DELETE FROM tagcount WHERE tagid = old.id;
+END;
+''',
+# 3: the full text of articles, fetched ahead of reading by --prefetch and compressed with zlib
+'''
+CREATE TABLE article (itemid INTEGER PRIMARY KEY REFERENCES item(id), fetchtime INT NOT NULL, size INT NOT NULL DEFAULT 0, text BLOB);
+CREATE INDEX article_fetchtime ON article (fetchtime);
+''',
+# 4: canonical item URLs; this rewrote the links of items, which is now left to the key of version 11
+'',
+# 5: clusters of near-duplicate items, found through the bands of their MinHash signatures
+'''
+ALTER TABLE item ADD COLUMN cluster INT REFERENCES item(id);
+ALTER TABLE item ADD COLUMN minhash BLOB;
+CREATE TABLE itemband (band INT NOT NULL, hash INT NOT NULL, itemid INT NOT NULL REFERENCES item(id), PRIMARY KEY (band, hash, itemid)) WITHOUT ROWID;
+''',
+# 6: the last response of every source, kept by --rawcache in a file named after its SHA-256
+'''
+CREATE TABLE rawcache (sourceid INTEGER PRIMARY KEY REFERENCES source(id), hash CHAR(64) NOT NULL, headers TEXT, fetchtime INT NOT NULL, size INT NOT NULL DEFAULT 0);
+CREATE INDEX rawcache_hash ON rawcache (hash);
+''',
+# 7: the sources --worker processes have claimed, until when
+'''
+CREATE TABLE lease (sourceid INTEGER PRIMARY KEY REFERENCES source(id), worker VARCHAR(128) NOT NULL, expires INT NOT NULL);
+CREATE INDEX lease_worker ON lease (worker);
+''',
+# 8: finding the other items of a cluster, to mark them as read with the one --serve shows
+'''
+CREATE INDEX item_cluster ON item (cluster);
+''',
+# 9: the items read last, for -c and -C, without sorting all of them
+'''
+CREATE INDEX item_readtime ON item (readtime);
+''',
+# 10: the unread items in the order of their time, for the reader, and the views saved by --saveview
+'''
+CREATE INDEX item_unread ON item (saved, time) WHERE readtime = 0;
+CREATE TABLE view (name VARCHAR(64) PRIMARY KEY NOT NULL, options TEXT NOT NULL);
+''',
+# 11: the key of every item, so a link to an item we have is known whatever variant of its URL it is
+addurlkeys,
+]
+
+def upgradedb(conn):
+    # takes the database through the steps in migrations it hasn't had yet, each in its own transaction
+    cur = conn.cursor()
+    cur.execute('PRAGMA user_version')
+    version = cur.fetchone()[0]
+    if version >= len(migrations):
+        return
+    if args.readonly:
+        logging.error("The database needs to be upgraded, which can't be done in read-only mode; run the program once without -R")
+        quit()
+    for v in range(version,len(migrations)):
+        logging.info('Upgrading the database to version %d' % ( v+1 ))
+        try:
+            if callable(migrations[v]):
+                cur.execute('BEGIN')
+                migrations[v](cur)
+                cur.execute('PRAGMA user_version = %d' % ( v+1 ) )
+                conn.commit()
+            else:
+                cur.executescript('BEGIN;\n%s\nPRAGMA user_version = %d;\nCOMMIT;' % ( migrations[v], v+1 ) )
+        except sqlite3.Error as err:
+            conn.rollback()
+            logging.error("Couldn't upgrade the database to version %d: %s" % ( v+1, err ) )
+            quit()
+    # give back the space the old tables took
+    cur.execute('VACUUM')
+
 # if the database doesn't exist, we need to create it
 # this guides the user through that process
 if not(os.path.isfile(dbfile)):
@@ -140,11 +459,19 @@ if not(os.path.isfile(dbfile)):
     cur.execute('''CREATE TABLE item (url VARCHAR(1024) PRIMARY KEY NOT NULL, source VARCHAR(1024) NOT NULL, time INT DEFAULT 0, readtime INT DEFAULT 0, addtime INT DEFAULT 0, title VARCHAR(300), author VARCHAR(256), description VARCHAR(4096) DEFAULT '', saved INT DEFAULT 0);''')
     cur.execute('''CREATE TABLE tag (tag VARCHAR(64) NOT NULL, url VARCHAR(1024) NOT NULL, FOREIGN KEY (url) REFERENCES item(url));''')
 #    cur.execute('''CREATE TABLE entry (url VARCHAR(1024) PRIMARY KEY NOT NULL, timestamp INT DEFAULT 1, description VARCHAR(4096) DEFAULT "");''')
+    upgradedb(conn)
     quit("The database has now been initialised. You can now use the program to add URLs. Run\n\trsscli.pl -h\nfor help")
 
 # we use global variables for the SQLite database connection and cursos
-conn = sqlite3.connect(dburl,uri=True)
-cur = conn.cursor()
+with phase('db open'):
+    conn = sqlite3.connect(dburl,uri=True)
+    cur = conn.cursor()
+    upgradedb(conn)
+    if not args.readonly:
+        # with a write-ahead log a commit only has to wait for the disk at a checkpoint, and the database is
+        # still consistent after a crash; at worst the last commits are lost
+        cur.execute('PRAGMA journal_mode = WAL')
+        cur.execute('PRAGMA synchronous = NORMAL')
 
 # defining the colours (or not, if blackwhite is set)
 def __red(text):
@@ -158,6 +485,43 @@ def __bold(text):
 def __underline(text):
     return (text if blackwhite else '\u001b[4m' + text + '\033[0m')
 
+# the options that choose the items the reader shows, which --saveview saves under a name, with their flags
+viewoptions = { 'min' : '-i', 'max' : '-m', 'saved' : '-s', 'reverse' : '-e', 'rank' : '--rank' }
+
+def saveview(name):
+    cur.execute('INSERT OR REPLACE INTO view (name, options) VALUES (?, ?)', ( name, json.dumps({ option : getattr(args,option) for option in viewoptions }) ) )
+    conn.commit()
+    myprint('Saved view %s' % __blue(name))
+
+def listviews():
+    cur.execute('SELECT name, options FROM view ORDER BY name')
+    for name, options in cur.fetchall():
+        # the options as they would be given on the command line
+        flags = [ viewoptions[option] if option in ( 'saved', 'reverse' ) else '%s %s' % ( viewoptions[option], value ) for option, value in json.loads(options).items() if value ]
+        myprint('%s: %s' % ( __blue(name), ' '.join(flags) ))
+
+if (args.saveview):
+    saveview(args.saveview)
+    quit()
+
+if (args.view == ''):
+    with listing():
+        listviews()
+    quit()
+
+if (args.view):
+    cur.execute('SELECT options FROM view WHERE name = ?', ( args.view, ) )
+    one = cur.fetchone()
+    if not one:
+        logging.error('There is no view %s' % args.view )
+        quit()
+    for option, value in json.loads(one[0]).items():
+        setattr(args, option, value)
+    saved = 1 if args.saved else 0
+    sortorder = 'ASC' if args.reverse else 'DESC'
+    minweight = int(args.min)
+    maxweight = int(args.max)
+
 def ago(num):
     # rather than 3693 seconds ago, we say 1h1m33s ago etc.
     if num == 0:
@@ -273,28 +637,123 @@ def addfromcsv(file):
    
 def listurls():
     # list all source URL and their name, weight and last update time
-    cur.execute('SELECT * FROM source WHERE weight >= %d AND weight <= %d ORDER BY lastupdated %s' % ( minweight , maxweight , sortorder ));
+    cur.execute('SELECT url, name, lastchecked, lastupdated, weight FROM source WHERE weight >= %d AND weight <= %d ORDER BY lastupdated %s' % ( minweight , maxweight , sortorder ));
     rows = cur.fetchall()
 #    rows.sort(key=lambda x: x[1])
     now = int(time.time())
     for line in rows:
         myprint("%s (%s) Weight: %d; Last updated: %s" % (__red(line[1]) , line[0] , line[4], __blue(ago(now - line[3] if line[3] else 0) ) ) )
 
-def listtags(limit):
-    # list all tags, with the number of URLs tagged as such, ordered by this number. Optionally limits the number
-    tags = {}
-    cur.execute('SELECT * FROM tag')
-    rows = cur.fetchall()
-    for line in rows:
-        tag = line[0]
-        tags[tag] = 1 if not (tag in tags) else tags[tag]+1
-    sortedtags = sorted(tags,key=lambda x: tags[x],reverse=(False if sortorder == 'ASC' else True))
-    if limit:
-        sortedtags = sortedtags[:limit]
-    for t in sortedtags:
-        myprint("%s: %d" % (t, tags[t] ))
-
-def updateurl(url,name,lastchecked,lastupdated):
+def listtags(limit,prefix='',since=None,until=None):
+    # list all tags, with the number of URLs tagged as such, ordered by this number. Optionally limits the number,
+    # to tags starting with prefix and to items from between since and until
+    where = [ ]
+    params = [ ]
+    if prefix:
+        # a range rather than LIKE, so the index on the tag names is used
+        where.append('tag.tag >= ? AND tag.tag < ?')
+        params += [ prefix, prefix[:-1] + chr(ord(prefix[-1])+1) ]
+    if since is None and until is None:
+        # the counts are kept in tagcount
+        where.append('tagcount.count > 0')
+        query = 'SELECT tag.tag, tagcount.count FROM tagcount JOIN tag ON tag.id = tagcount.tagid WHERE %s ORDER BY tagcount.count %s, tag.tag LIMIT %d'
+    else:
+        if since is not None:
+            where.append('item.time >= %d' % since)
+        if until is not None:
+            where.append('item.time < %d' % until)
+        query = 'SELECT tag.tag, count(*) FROM itemtag JOIN tag ON tag.id = itemtag.tagid JOIN item ON item.id = itemtag.itemid WHERE %s GROUP BY itemtag.tagid ORDER BY count(*) %s, tag.tag LIMIT %d'
+    cur.execute(query % ( ' AND '.join(where), sortorder, limit if limit > 0 else -1 ), params )
+    for tag, count in cur.fetchall():
+        myprint("%s: %d" % ( tag, count ))
+
+# statistics for every source checked during -u; each thread appends a dictionary to this list
+fetchstats = []
+fetchstatsfields = ['url', 'name', 'time', 'status', 'connecttime', 'downloadtime', 'parsetime', 'dbtime', 'bytes', 'new', 'updated', 'known', 'finalurl']
+
+def fetchfeed(url):
+    # downloads a feed, following any redirects
+    # returns the response, the body, the seconds until the headers came in (DNS, connecting and waiting
+    # for the server) and the seconds spent downloading the body
+    start = time.perf_counter()
+    r = requests.get(url, headers={'User-Agent': feedparser.USER_AGENT}, timeout=30, verify=not args.insecure, stream=True)
+    connecttime = time.perf_counter() - start
+    content = r.content
+    downloadtime = time.perf_counter() - start - connecttime
+    return(r, content, connecttime, downloadtime)
+
+# near-duplicates: the same story from different sources, often with a slightly different title or summary.
+# Every new item gets a MinHash signature of the pairs of consecutive words in its title and summary; the
+# signature is cut into bands and every band is stored in itemband. Items with a band in common are the
+# candidates, found through the index whatever the number of items, and a candidate whose signature agrees
+# with the new one in at least minhashsimilarity of the values is a near-duplicate
+minhashcount = 24
+minhashbands = 6
+minhashsimilarity = 0.6
+minhashprime = ( 1 << 61 ) - 1
+rnd = random.Random(37) # the same hash functions in every run
+minhashparams = [ ( rnd.randrange(1,minhashprime), rnd.randrange(minhashprime) ) for i in range(minhashcount) ]
+
+def minhash(title,summary):
+    # the MinHash signature of an item, packed for the database, and the key of every band of it; None if
+    # there are no words to go by
+    words = re.findall(r'\w+', ( title + ' ' + re.sub('<.*?>',' ',summary) ).lower())[:100]
+    shingles = set( a + ' ' + b for a, b in zip(words,words[1:]) ) or set(words)
+    if not shingles:
+        return(None)
+    hashes = [ int.from_bytes(hashlib.blake2b(s.encode('utf-8'),digest_size=8).digest(),'big') for s in shingles ]
+    signature = [ min( ( a * h + b ) % minhashprime for h in hashes ) for a, b in minhashparams ]
+    rows = minhashcount // minhashbands
+    # signed, as SQLite integers are
+    bands = [ int.from_bytes(hashlib.blake2b(struct.pack('<%dQ' % rows, *signature[band*rows:(band+1)*rows]),digest_size=8).digest(),'big',signed=True) for band in range(minhashbands) ]
+    return( struct.pack('<%dQ' % minhashcount, *signature), bands )
+
+def findcluster(cur,sourceid,signature,bands):
+    # the cluster of a near-duplicate of an item with this signature from another source; None if there is none
+    signature = struct.unpack('<%dQ' % minhashcount, signature)
+    for band, key in enumerate(bands):
+        cur.execute('SELECT item.id, item.cluster, item.minhash FROM itemband JOIN item ON item.id = itemband.itemid WHERE itemband.band = ? AND itemband.hash = ? AND item.sourceid != ?', ( band, key, sourceid ) )
+        for itemid, cluster, other in cur.fetchall():
+            if sum( x == y for x, y in zip(signature, struct.unpack('<%dQ' % minhashcount, other)) ) >= minhashsimilarity * minhashcount:
+                return(cluster if cluster else itemid)
+    return(None)
+
+def normalizeentry(e,origurl,now):
+    # turns a feedparser entry into an Item; the time is the first of the updated, published and created
+    # times that can be converted, or now if there is none
+    # we use the entry as the plain dictionary it is: feedparser's attribute access is slow and, for a
+    # missing attribute, raises an exception that hasattr has to catch
+    thetime = now
+    for field in ( 'updated_parsed', 'published_parsed', 'created_parsed' ):
+        parsed = dict.get(e,field)
+        if parsed:
+            try:
+                thetime = int(time.mktime(parsed))
+                break
+            except (OverflowError, ValueError):
+                logging.warning('%s for %s cannot be parsed' % ( field, origurl ) )
+    return( Item( dict.get(e,'link',''), origurl, thetime, dict.get(e,'title',''), dict.get(e,'author',''), dict.get(e,'summary',''), 0 ) )
+
+def parsefeed(content,headers,origurl,now):
+    # parses a downloaded feed; this runs in one of the --parsers processes, so that parsing isn't limited
+    # to a single core by the GIL
+    # returns whether the feed is possibly invalid, an Item for every entry, their minhash() and the seconds
+    # parsing took
+    start = time.perf_counter()
+    feed = feedparser.parse( io.BytesIO(content), response_headers=headers )
+    entries = [ normalizeentry(e,origurl,now) for e in feed['entries'] ]
+    signatures = [ minhash(e.title,e.content) for e in entries ]
+    return( 1 if feed.get('bozo') else 0, entries, signatures, time.perf_counter() - start )
+
+# the processes feeds are parsed in during -u; None if they're parsed in the fetching threads
+parsepool = None
+
+# the urlkey of every item in the database, read once at the start of -u, so an item we already have is skipped
+# without asking the database; the lock makes checking and adding a key one step for the fetching threads
+seen = set()
+seenlock = threading.Lock()
+
+def updateurl(sourceid,url,name,lastchecked,lastupdated):
     # we need to reintialize conn and cur, because we'll operate inside a thread!
     origurl = url
     conn = sqlite3.connect(dburl, uri=True, timeout=15) # timeout added because the threads may block writing to database
@@ -304,110 +763,536 @@ def updateurl(url,name,lastchecked,lastupdated):
 #    if newpid: continue
     logging.info("Checking %s (%s) for updates (last checked %d seconds ago)" % ( __red(name),__blue(url),now - lastchecked))
     if lastchecked == 0 or (now - lastchecked) > int(args.checkfrequency):
-        feed = {}
+        stats = newstats(sourceid,origurl,name,now)
+        bozo = 0
+        entries = []
+        signatures = []
         status = 999
         c = 0 # counter
-#        myprint("%s (%s): %d" % ( url, feed['href'], feed['status'] ) )
+        permanent = origurl # where the feed has moved to permanently, if it has
+        temporary = False # whether we were redirected temporarily on the way
         try:
+            # we download the feed ourselves rather than letting feedparser do it, so we can time every step
             while ( status != 200 and status != 404 and c < 10 ):
-                feed = feedparser.parse( url )
-                if 'status' in feed: status = feed['status']
+                r, content, connecttime, downloadtime = fetchfeed( url )
+                status = r.status_code
+                url = r.url
+                # follow the permanent redirects from where the feed was last, up to the first temporary one
+                for i, h in enumerate(r.history):
+                    if h.status_code in ( 301, 308 ) and h.url == permanent:
+                        permanent = ( r.history[i+1] if i+1 < len(r.history) else r ).url
+                    if h.status_code not in ( 301, 308 ):
+                        temporary = True
                 c = c + 1
-                if 'href' in feed:
-                    url = feed['href']
-                else:
-                    c = 10
+                stats['connecttime'] += connecttime
+                stats['downloadtime'] += downloadtime
+                stats['bytes'] += len(content)
                 logging.debug('Status for %s is %d (%s)' % ( origurl, status, url ) )
+            stats['status'] = status
+            stats['finalurl'] = url
             if status == 404: logging.warning('Status for %s is 404' % origurl )
-            if status == 301: logging.warning('Status for %s is 301; redirect to %s' % ( origurl , url ) )
+            headers = { k.lower() : v for k, v in r.headers.items() }
+            headers['content-location'] = url # so relative links are resolved correctly
+            if args.rawcache and status == 200:
+                try:
+                    storeraw(cur,sourceid,headers,content)
+                except (OSError, sqlite3.Error) as err:
+                    logging.warning("Can't keep the response of %s: %s" % ( __blue(origurl), err ) )
+            if parsepool:
+                bozo, entries, signatures, stats['parsetime'] = parsepool.submit(parsefeed, content, headers, origurl, now).result()
+            else:
+                bozo, entries, signatures, stats['parsetime'] = parsefeed(content, headers, origurl, now)
+            # only a real feed that we got to through permanent redirects says two sources are the same feed; a
+            # temporary redirect may go to e.g. a consent page that many feeds send us to
+            stats['samefeed'] = status == 200 and not temporary and not bozo and len(entries) > 0
         except:
             logging.error("Something went wrong with %s (%d)" % ( origurl , status ) )
+        start = time.perf_counter()
+        if permanent != origurl and stats['samefeed']:
+            # the source gets the new URL, so we don't follow the redirect again; its items stay with it as they
+            # refer to its id. If we already have the new URL as a source, the two become one. A dead site often
+            # redirects permanently to a parked page, so only a valid feed with entries there counts
+            try:
+                cur.execute('SELECT id FROM source WHERE url = ?', ( permanent, ) )
+                one = cur.fetchone()
+                if one:
+                    mergesource(cur,sourceid,one[0])
+                    logging.warning('%s has moved to %s, which is also a source; merged the two' % ( __blue(origurl), __blue(permanent) ) )
+                    sourceid = stats['sourceid'] = one[0]
+                else:
+                    cur.execute('UPDATE source SET url = ? WHERE id = ?', ( permanent, sourceid ) )
+                    logging.warning('%s has moved to %s; changed the URL of the source' % ( __blue(origurl), __blue(permanent) ) )
+                conn.commit()
+            except sqlite3.Error as err:
+                logging.error("Can't change the URL of %s to %s: %s" % ( __blue(origurl), __blue(permanent), err ) )
+        elif permanent != origurl:
+            logging.warning("%s redirects permanently to %s, but there is no valid feed with entries at the end; kept the URL of the source" % ( __blue(origurl), __blue(permanent) ) )
         try:
-            cur.execute('UPDATE source SET lastchecked = %d WHERE url = "%s"' % ( now, origurl ) )
+            cur.execute('UPDATE source SET lastchecked = %d WHERE id = %d' % ( now, sourceid ) )
 #            conn.commit()
         except sqlite3.Error as err:
             logging.error("Can't set last checked date for %s: %s" % (__blue(url), err.args[0]))
-        if( 'bozo' in feed and feed['bozo'] ):
+        if bozo:
             logging.warning("Feed for %s (%s) is possibly invalid; proceeding anyway" % (__red(name),__blue(url)))
 #            os._exit(0)
-        updated = 0
-        if 'entries' in feed.keys():
-            # added 2020-02-07 
-            # I only got this error when run remotely but just in case
-            for e in feed['entries']:
-                try:
-                    # we can't be certain these arguments exist, so we need to check first
-                    link = ''
-                    if hasattr(e,'link'): link = e.link
-                    author = ''
-                    if hasattr(e,'author'): author = e.author
-                    title = ''
-                    if hasattr(e,'title'): title = e.title
-                    title = title.replace('"','""')
-                    # next two lines are a fix because some feeds (CISA) have the URL as a link in the title...
-                    summary = ''
-                    if hasattr(e,'summary'): summary = e.summary
-                    summary = summary.replace('"','""')
-                    thetime = now
-                    try:
-                        if hasattr(e,'created_parsed'): thetime = time.mktime(e.created_parsed)
-                    except:
-                        logging.warning('Created time for %s cannot be parsed' % origurl )
-                    try:
-                        if hasattr(e,'published_parsed'): thetime = time.mktime(e.published_parsed)
-                    except:
-                        logging.warning('Published time for %s cannot be parsed' % origurl )
-                    try:
-                        if hasattr(e,'updated_parsed'): thetime = time.mktime(e.updated_parsed)
-                    except:
-                        logging.warning('Updated time for %s cannot be parsed' % origurl )
-                    # we are using REPLACE here: things may have changed. It is obviously a bit slower though
-                    # note that we do not remove links that have been removed from the feed, e.g. because the URL has been updated!
-                    #cur.execute('INSERT INTO item (url, source, time, addtime, title, author, description, saved) VALUES ("%s", "%s", %d, %d, "%s", "%s", "%s" , %d) ON CONFLICT REPLACE INTO item ( time, addtime, title, author, description ) VALUES ( "%d" , "%d", "%s", "%s", "%s" ) WHERE url = "%s";' % (e.link , url , thetime , now , title, author, summary , 0 , thetime, now, title, author, summary, url ))
-                    cur.execute('SELECT count(*) FROM item WHERE url = "%s"' % link )
-                    if cur.fetchone()[0]:
-                        cur.execute('UPDATE item SET title = "%s", author = "%s", description = "%s" WHERE url = "%s"' % (title, author, summary, link ) )
-                    else:
-                        cur.execute('INSERT INTO item (url, source, time, readtime, addtime, title, author, description, saved) VALUES ("%s", "%s", %d, %d, %d, "%s", "%s", "%s" , %d)' % (link , origurl , thetime , 0, now , title, author, summary , 0  ))
-    #                conn.commit()
-                    logging.info("%s (%s) added or updated" % (__red(title), __blue(link)))
-                    updated = 1
-                except sqlite3.Error as err:
-                    logging.warning("Can't add item (%s) to database: %s" % (__blue(e.link), err.args[0]))
+        updated = storeentries(cur,sourceid,entries,signatures,now,stats)
         if updated:
             try:
-                cur.execute('UPDATE source SET lastupdated = %d WHERE url = "%s"' % ( now, origurl ) )
+                cur.execute('UPDATE source SET lastupdated = %d WHERE id = %d' % ( now, sourceid ) )
                 conn.commit()
             except sqlite3.Error as err:
                 logging.warning("Can't set last updated date for %s: %s" % (__blue(url), err.args[0]))
+        conn.commit()
+        stats['dbtime'] = time.perf_counter() - start
     else:
         logging.info("Checked %s too recently" % __red(name) )
     conn.commit()
+
+def newstats(sourceid,url,name,now):
+    # the statistics of checking a source, to be filled in as we go
+    stats = { 'sourceid' : sourceid, 'url' : url, 'name' : name, 'time' : now, 'status' : 0, 'connecttime' : 0.0, 'downloadtime' : 0.0, 'parsetime' : 0.0, 'dbtime' : 0.0, 'bytes' : 0, 'new' : 0, 'updated' : 0, 'known' : 0, 'finalurl' : url, 'samefeed' : False }
+    fetchstats.append(stats)
+    return(stats)
+
+def storeentries(cur,sourceid,entries,signatures,now,stats):
+    # adds the items of a source we don't have yet; the items we have get the title, author and summary in the
+    # entries if these have changed. Returns whether anything was added or changed
+    updated = 0
+    for e, signature in zip(entries,signatures):
+        # an item we already have from another source, or under another variant of its URL, is left alone
+        # note that we do not remove links that have been removed from the feed, e.g. because the URL has been updated!
+        key = urlkey(e.url)
+        with seenlock:
+            known = key in seen
+            seen.add(key)
+        try:
+            if known:
+                stats['known'] += 1
+                # only an item that has changed is written
+                cur.execute('UPDATE item SET title = ?, author = ?, description = ? WHERE urlkey = ? AND sourceid = ? AND ( title IS NOT ? OR author IS NOT ? OR description IS NOT ? )', ( e.title, e.author, e.content, key, sourceid, e.title, e.author, e.content ) )
+                stats['updated'] += cur.rowcount
+                updated = updated or cur.rowcount
+                continue
+            cluster = findcluster(cur,sourceid,*signature) if signature else None
+            cur.execute('INSERT OR IGNORE INTO item (url, urlkey, sourceid, time, readtime, addtime, title, author, description, saved, cluster, minhash) VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, 0, ?, ?)', ( e.url, key, sourceid, e.time, now, e.title, e.author, e.content, cluster, signature[0] if signature else None ) )
+            if signature and cur.rowcount:
+                cur.executemany('INSERT OR IGNORE INTO itemband (band, hash, itemid) VALUES (?, ?, ?)', [ ( band, key, cur.lastrowid ) for band, key in enumerate(signature[1]) ] )
+            stats['new'] += 1
+            logging.info("%s (%s) added" % (__red(e.title), __blue(e.url)))
+            updated = 1
+        except sqlite3.Error as err:
+            logging.warning("Can't add item (%s) to database: %s" % (__blue(e.url), err.args[0]))
+    return(updated)
+
+# the raw cache: the last response of every source, in gzip files named after the SHA-256 of the response, so
+# a response that is the same for several sources is kept once
+rawdir = configdir + 'raw/'
+
+def storeraw(cur,sourceid,headers,content):
+    # keeps a response in the raw cache in place of the previous one of the source
+    digest = hashlib.sha256(content).hexdigest()
+    path = rawdir + digest + '.gz'
+    if not os.path.exists(path):
+        os.makedirs(rawdir,exist_ok=True)
+        # written under another name first, so there never is half a file under this one
+        with gzip.open(path + '.%d' % threading.get_ident(),'wb') as f:
+            f.write(content)
+        os.replace(path + '.%d' % threading.get_ident(),path)
+    cur.execute('SELECT hash FROM rawcache WHERE sourceid = ?', ( sourceid, ) )
+    one = cur.fetchone()
+    cur.execute('INSERT OR REPLACE INTO rawcache (sourceid, hash, headers, fetchtime, size) VALUES (?, ?, ?, ?, ?)', ( sourceid, digest, json.dumps(headers), int(time.time()), os.path.getsize(path) ) )
+    if one and one[0] != digest:
+        removeraw(cur,one[0])
+
+def removeraw(cur,digest):
+    # deletes a file from the raw cache if no source refers to it any more
+    cur.execute('SELECT count(*) FROM rawcache WHERE hash = ?', ( digest, ) )
+    if not cur.fetchone()[0]:
+        try:
+            os.remove(rawdir + digest + '.gz')
+        except OSError:
+            pass
+
+def evictraw():
+    # removes the oldest responses until the raw cache fits in --rawcache megabytes
+    cur.execute('SELECT sourceid, hash FROM (SELECT sourceid, hash, sum(size) OVER (ORDER BY fetchtime DESC, sourceid DESC) AS total FROM rawcache) WHERE total > %d' % ( args.rawcache * 1024 * 1024 ) )
+    for sourceid, digest in cur.fetchall():
+        cur.execute('DELETE FROM rawcache WHERE sourceid = ?', ( sourceid, ) )
+        removeraw(cur,digest)
+    conn.commit()
+
+def mergesource(cur,fromid,intoid):
+    # moves the items and update statistics of a source to another one, which keeps the higher of the two
+    # weights, and deletes it
+    cur.execute('UPDATE item SET sourceid = ? WHERE sourceid = ?', ( intoid, fromid ) )
+    cur.execute('UPDATE fetchlog SET sourceid = ? WHERE sourceid = ?', ( intoid, fromid ) )
+    cur.execute('UPDATE source SET weight = max(weight, (SELECT weight FROM source WHERE id = ?)) WHERE id = ?', ( fromid, intoid ) )
+    cur.execute('DELETE FROM source WHERE id = ?', ( fromid, ) )
+    cur.execute('SELECT hash FROM rawcache WHERE sourceid = ?', ( fromid, ) )
+    one = cur.fetchone()
+    cur.execute('DELETE FROM rawcache WHERE sourceid = ?', ( fromid, ) )
+    if one:
+        removeraw(cur,one[0])
+
+def updateurlthread(slots,sourceid,url,name,lastchecked,lastupdated):
+    try:
+        updateurl(sourceid,url,name,lastchecked,lastupdated)
+    finally:
+        slots.release()
 #
+def startingest():
+    # what checking for updates and --reparse need before they start
+    global parsepool
+    if int(args.parsers) > 0:
+        # we fork the parsing processes now, before the fetching threads start, so none of them can hold a lock,
+        # e.g. of logging, that the parsers inherit. With --sample the sampler thread is already running, but the
+        # only lock it takes is that of its own event, which the parsers never use
+        parsepool = concurrent.futures.ProcessPoolExecutor(max_workers=int(args.parsers), mp_context=multiprocessing.get_context('fork'))
+        parsepool.submit(int).result()
+    cur.execute('SELECT urlkey FROM item')
+    seen.update( line[0] for line in cur )
+
 def updateurls():
-    cur.execute('SELECT * FROM source ORDER BY lastupdated ASC');
-    for line in cur.fetchall():
-#        url = line[0]
-#        name = line[1]
-#        lastchecked = line[2]
-#        lastupdated = line[3]
-#        updateurl(url,name,lastchecked,lastupdated)
-        while 1: # turn into while 1 and remove previous five lines to enable parallel
-            if (threading.active_count() < int(args.threads) + 1):
-                url = line[0]
-                name = line[1]
-                lastchecked = line[2]
-                lastupdated = line[3]
-                t = threading.Thread(target=updateurl,args=(url,name,lastchecked,lastupdated))
-                t.daemon = True
+    startingest()
+    # we claim the sources that are due like a worker does, so the sources workers are checking are left to
+    # them and a worker started meanwhile leaves ours to us
+    rows = claimsources(-1)
+    stop = threading.Event()
+    threading.Thread(target=heartbeat,args=(stop,),daemon=True).start()
+    threads = []
+    slots = threading.BoundedSemaphore(int(args.threads))
+    for line in rows:
+        # wait until fewer than --threads sources are being checked
+        slots.acquire()
+        sourceid = line[0]
+        url = line[1]
+        name = line[2]
+        lastchecked = line[3]
+        lastupdated = line[4]
+        t = threading.Thread(target=updateurlthread,args=(slots,sourceid,url,name,lastchecked,lastupdated))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    # wait for the last threads to finish, otherwise they are killed when we quit
+    for t in threads:
+        t.join()
+    stop.set()
+    cur.execute('DELETE FROM lease WHERE worker = ?', ( workername, ) )
+    conn.commit()
+    if parsepool:
+        parsepool.shutdown()
+    mergeduplicatesources()
+    if args.rawcache:
+        evictraw()
+    savefetchstats()
+
+def reparse():
+    # builds the items again from the raw cache; the responses are parsed by the --parsers processes while we
+    # store the items of those already parsed
+    startingest()
+    now = int(time.time())
+    cur.execute('SELECT rawcache.sourceid, source.url, source.name, rawcache.hash, rawcache.headers FROM rawcache JOIN source ON source.id = rawcache.sourceid')
+    rows = cur.fetchall()
+    pending = collections.deque()
+    def store():
+        stats, job = pending.popleft()
+        bozo, entries, signatures, stats['parsetime'] = job.result() if parsepool else parsefeed(*job)
+        start = time.perf_counter()
+        storeentries(cur,stats['sourceid'],entries,signatures,now,stats)
+        conn.commit()
+        stats['dbtime'] = time.perf_counter() - start
+    for sourceid, url, name, digest, headers in rows:
+        stats = newstats(sourceid,url,name,now)
+        try:
+            with gzip.open(rawdir + digest + '.gz','rb') as f:
+                content = f.read()
+        except OSError as err:
+            logging.warning("Can't read the response of %s: %s" % ( __blue(url), err ) )
+            continue
+        stats['status'] = 200
+        stats['bytes'] = len(content)
+        job = ( content, json.loads(headers), url, now )
+        pending.append( ( stats, parsepool.submit(parsefeed,*job) if parsepool else job ) )
+        # no more responses in memory than the parsers can work on
+        if len(pending) > 2 * int(args.parsers):
+            store()
+    while pending:
+        store()
+    if parsepool:
+        parsepool.shutdown()
+    myprint('%d items added and %d changed from the responses of %d sources' % ( sum(s['new'] for s in fetchstats), sum(s['updated'] for s in fetchstats), len(fetchstats) ) )
+    savefetchstats(log=False)
+
+# --worker: a worker claims sources in the lease table for leaseseconds and renews the claim every third of
+# that for as long as it is checking them, so the sources of a worker that died go to another one soon after
+leaseseconds = 60
+workername = '%s:%d' % ( socket.gethostname(), os.getpid() )
+
+def claimsources(number):
+    # claims up to number sources, or all of them if number is -1, that are due and that no other worker or -u
+    # has claimed; the transaction takes the write lock at the start, so workers claiming at the same time wait
+    # for each other rather than fail
+    now = int(time.time())
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute('DELETE FROM lease WHERE expires < %d' % now )
+        cur.execute('SELECT id, url, name, lastchecked, lastupdated FROM source WHERE lastchecked < %d AND id NOT IN (SELECT sourceid FROM lease) ORDER BY lastchecked ASC LIMIT %d' % ( now - int(args.checkfrequency), number ) )
+        rows = cur.fetchall()
+        cur.executemany('INSERT INTO lease (sourceid, worker, expires) VALUES (?, ?, ?)', [ ( line[0], workername, now + leaseseconds ) for line in rows ] )
+        conn.commit()
+    except sqlite3.Error as err:
+        conn.rollback()
+        logging.warning("Can't claim sources: %s" % err )
+        return([])
+    return(rows)
+
+def heartbeat(stop):
+    # renews the claims of this worker until stop is set
+    # we need our own connection, because we'll operate inside a thread!
+    conn = sqlite3.connect(dburl, uri=True, timeout=15)
+    while not stop.wait(leaseseconds / 3):
+        try:
+            conn.execute('UPDATE lease SET expires = ? WHERE worker = ?', ( int(time.time()) + leaseseconds, workername ) )
+            conn.commit()
+        except sqlite3.Error as err:
+            logging.warning("Can't renew the claims of %s: %s" % ( workername, err ) )
+    conn.close()
+
+def work():
+    # checks the sources that are due, claiming --threads at a time, and reports to the database like -u
+    while True:
+        startingest()
+        stop = threading.Event()
+        threading.Thread(target=heartbeat,args=(stop,),daemon=True).start()
+        while True:
+            rows = claimsources(int(args.threads))
+            if not rows:
+                break
+            logging.info('%s claimed %d sources' % ( workername, len(rows) ) )
+            threads = [ threading.Thread(target=updateurl,args=line,daemon=True) for line in rows ]
+            for t in threads:
                 t.start()
+            for t in threads:
+                t.join()
+            cur.execute('DELETE FROM lease WHERE worker = ?', ( workername, ) )
+            conn.commit()
+        stop.set()
+        if parsepool:
+            parsepool.shutdown()
+        mergeduplicatesources()
+        if args.rawcache:
+            evictraw()
+        logging.info('%s checked %d sources' % ( workername, len(fetchstats) ) )
+        savefetchstats()
+        fetchstats.clear()
+        seen.clear()
+        if not args.worker:
+            break
+        time.sleep(args.worker)
+
+def mergeduplicatesources():
+    # sources whose feeds ended up at the same URL through permanent redirects, with a valid feed with entries
+    # there, are one source: the oldest keeps the items of the others
+    final = {}
+    for stats in fetchstats:
+        if stats['samefeed']:
+            final.setdefault(stats['finalurl'],set()).add(stats['sourceid'])
+    for url, ids in final.items():
+        if len(ids) < 2:
+            continue
+        keep = min(ids)
+        try:
+            for sourceid in ids - { keep }:
+                mergesource(cur,sourceid,keep)
+            conn.commit()
+            logging.warning('%d sources are the feed at %s; merged them' % ( len(ids), __blue(url) ) )
+        except sqlite3.Error as err:
+            logging.error("Can't merge the sources of %s: %s" % ( __blue(url), err ) )
+            continue
+        for stats in fetchstats:
+            if stats['sourceid'] in ids:
+                stats['sourceid'] = keep
+
+def mergedb(filename):
+    # merges the rsscli database in filename into ours with a handful of statements over the attached database,
+    # all in one transaction. Items are matched by urlkey and sources by feed URL; where both databases have an
+    # item, the copy with the later readtime wins and it gets the tags of both, and where both have a source,
+    # the copy with the later lastchecked keeps its name and weight
+    if not os.path.isfile(filename):
+        logging.error("There's no database %s to merge" % filename )
+        quit()
+    # the other database is only read; if it's from an older version of the program, a copy of it is upgraded
+    other = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(filename))
+    copy = None
+    try:
+        try:
+            conn2 = sqlite3.connect(other, uri=True)
+            version = conn2.execute('PRAGMA user_version').fetchone()[0]
+            if version > len(migrations):
+                logging.error("%s is from a newer version of the program" % filename )
+                quit()
+            if version < len(migrations):
+                fd, copy = tempfile.mkstemp(suffix='.db')
+                os.close(fd)
+                conn3 = sqlite3.connect(copy)
+                conn2.backup(conn3)
+                upgradedb(conn3)
+                conn3.close()
+                other = copy
+            conn2.close()
+            cur.execute('ATTACH DATABASE ? AS other', ( other, ) )
+        except sqlite3.Error as err:
+            logging.error("Can't read %s: %s" % ( filename, err ) )
+            quit()
+        mergeattached(filename)
+    finally:
+        if copy: os.remove(copy)
+
+def mergeattached(filename):
+    # merges the database attached as other, which came from filename, and detaches it
+    try:
+        cur.execute('BEGIN')
+        cur.execute('INSERT INTO source (url, name, lastchecked, lastupdated, weight) SELECT url, name, lastchecked, lastupdated, weight FROM other.source WHERE url NOT IN (SELECT url FROM source) ORDER BY id')
+        newsources = cur.rowcount
+        cur.execute('UPDATE source SET (name, weight, lastchecked, lastupdated) = (SELECT o.name, o.weight, o.lastchecked, o.lastupdated FROM other.source AS o WHERE o.url = source.url) WHERE url IN (SELECT o.url FROM other.source AS o JOIN source AS s ON s.url = o.url WHERE o.lastchecked > s.lastchecked)')
+        # the items whose state comes from the other database, with their ids in both: those read there
+        # later than here, and those we don't have, which get ids after the ones we have
+        cur.execute('CREATE TEMP TABLE mergeitem (otherid INTEGER PRIMARY KEY, id INT NOT NULL, new INT NOT NULL)')
+        cur.execute('CREATE INDEX mergeitem_id ON mergeitem (id)')
+        cur.execute('INSERT OR IGNORE INTO mergeitem (otherid, id, new) SELECT o.id, i.id, 0 FROM other.item AS o JOIN item AS i ON i.urlkey = o.urlkey WHERE o.readtime > i.readtime')
+        updated = cur.rowcount
+        cur.execute('SELECT coalesce(max(id),0) FROM item')
+        lastid = cur.fetchone()[0]
+        cur.execute('INSERT INTO item (url, urlkey, sourceid, time, readtime, addtime, title, author, description, saved, minhash) SELECT o.url, o.urlkey, s.id, o.time, o.readtime, o.addtime, o.title, o.author, o.description, o.saved, o.minhash FROM other.item AS o LEFT JOIN other.source AS os ON os.id = o.sourceid LEFT JOIN source AS s ON s.url = os.url WHERE o.urlkey NOT IN (SELECT urlkey FROM item) ORDER BY o.id')
+        new = cur.rowcount
+        cur.execute('INSERT INTO mergeitem (otherid, id, new) SELECT o.id, i.id, 1 FROM other.item AS o JOIN item AS i ON i.url = o.url WHERE i.id > ?', ( lastid, ) )
+        cur.execute('UPDATE item SET readtime = (SELECT o.readtime FROM mergeitem AS m JOIN other.item AS o ON o.id = m.otherid WHERE m.id = item.id) WHERE id IN (SELECT id FROM mergeitem WHERE new = 0)')
+        # an item is never unsaved, so one saved in either database is saved
+        cur.execute('UPDATE item SET saved = 1 WHERE saved = 0 AND urlkey IN (SELECT urlkey FROM other.item WHERE saved = 1)')
+        # tags have no time to tell which copy is newer, so an item gets the tags it has in either database; the
+        # triggers keep tagcount up to date
+        cur.execute('INSERT OR IGNORE INTO tag (tag) SELECT DISTINCT ot.tag FROM other.itemtag AS oit JOIN other.tag AS ot ON ot.id = oit.tagid')
+        cur.execute('INSERT OR IGNORE INTO itemtag (tagid, itemid) SELECT t.id, i.id FROM other.itemtag AS oit JOIN other.item AS o ON o.id = oit.itemid JOIN item AS i ON i.urlkey = o.urlkey JOIN other.tag AS ot ON ot.id = oit.tagid JOIN tag AS t ON t.tag = ot.tag ORDER BY oit.rowid')
+        # new items keep their near-duplicates and the articles fetched for them
+        cur.execute('UPDATE item SET cluster = (SELECT coalesce(c.cluster, c.id) FROM mergeitem AS m JOIN other.item AS o ON o.id = m.otherid JOIN other.item AS oc ON oc.id = o.cluster JOIN item AS c ON c.urlkey = oc.urlkey WHERE m.id = item.id) WHERE id IN (SELECT id FROM mergeitem WHERE new = 1)')
+        cur.execute('INSERT OR IGNORE INTO itemband (band, hash, itemid) SELECT b.band, b.hash, m.id FROM other.itemband AS b JOIN mergeitem AS m ON m.otherid = b.itemid WHERE m.new = 1')
+        cur.execute('INSERT OR IGNORE INTO article (itemid, fetchtime, size, text) SELECT m.id, a.fetchtime, a.size, a.text FROM other.article AS a JOIN mergeitem AS m ON m.otherid = a.itemid WHERE m.new = 1')
+        cur.execute('DROP TABLE mergeitem')
+        conn.commit()
+    except sqlite3.Error as err:
+        conn.rollback()
+        logging.error("Couldn't merge %s: %s" % ( filename, err ) )
+        quit()
+    finally:
+        cur.execute('DETACH DATABASE other')
+    myprint('Merged %s: %d new sources, %d new items, %d items read there later' % ( __blue(filename), newsources, new, updated ) )
+
+def savefetchstats(log=True):
+    # keep the statistics of this run in the database and remove those older than --historydays; with log
+    # false, only write the --report
+    if log:
+        try:
+            cur.executemany('INSERT INTO fetchlog (sourceid, time, status, connecttime, downloadtime, parsetime, dbtime, bytes, new, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [ ( s['sourceid'], s['time'], s['status'], s['connecttime'], s['downloadtime'], s['parsetime'], s['dbtime'], s['bytes'], s['new'], s['updated'] ) for s in fetchstats ] )
+            cur.execute('DELETE FROM fetchlog WHERE time < %d' % ( int(time.time()) - 86400 * int(args.historydays) ) )
+            conn.commit()
+        except sqlite3.Error as err:
+            logging.error("Can't store the update statistics: %s" % err )
+    if args.report:
+        # slowest sources first, as these are the ones you want to look at
+        rows = sorted(fetchstats, key=lambda x: x['connecttime'] + x['downloadtime'] + x['parsetime'] + x['dbtime'], reverse=True)
+        with open(args.report,'w',newline='') as f:
+            if args.report.endswith('.json'):
+                json.dump(rows, f, indent=1)
+            else:
+                writer = csv.DictWriter(f, fieldnames=fetchstatsfields, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(rows)
+        logging.info('Wrote statistics for %d sources to %s' % ( len(rows), args.report ) )
+
+# the most of a page fetcharticle reads; the rest of a longer one is left out
+articlebytes = 2 * 1024 * 1024
+
+def fetcharticle(url):
+    # downloads the page of an item and returns the readable text in it: the paragraphs, headings, lists and
+    # quotes of the article or the main part of the page if it marks these, of the whole page otherwise
+    # the body is streamed, so a link to e.g. a podcast or a PDF is dropped after the headers rather than downloaded
+    with requests.get(url, headers={'User-Agent': feedparser.USER_AGENT}, timeout=30, verify=not args.insecure, stream=True) as r:
+        if r.status_code != 200 or 'html' not in r.headers.get('content-type','text/html'):
+            return(None)
+        content = bytearray()
+        for chunk in r.iter_content(65536):
+            content += chunk
+            if len(content) >= articlebytes:
                 break
-            time.sleep(1)
+    html = bs4(bytes(content[:articlebytes]),'lxml')
+    for junk in html(['script','style','noscript','nav','header','footer','aside','form','iframe']):
+        junk.decompose()
+    main = html.find('article') or html.find('main') or html.body or html
+    blocks = [ ' '.join(block.get_text(' ').split()) for block in main.find_all(['p','h1','h2','h3','h4','h5','h6','li','pre','blockquote']) if not block.find_parent(['li','blockquote']) ]
+    text = '\n\n'.join(block for block in blocks if block)
+    if not text:
+        text = '\n'.join(line.strip() for line in main.get_text().splitlines() if line.strip())
+    return(text)
+
+def prefetcharticles(urls):
+    # fetches the articles of those items among urls we don't have yet, --threads at a time, and stores their
+    # text; an article that can't be fetched is stored empty, so it isn't tried again until it is evicted
+    # we need our own connection, because this may run inside a thread
+    conn = sqlite3.connect(dburl, uri=True, timeout=15)
+    cur = conn.cursor()
+    todo = {}
+    for url in urls:
+        cur.execute('SELECT item.id FROM item LEFT JOIN article ON article.itemid = item.id WHERE item.url = ? AND article.itemid IS NULL', ( url, ) )
+        one = cur.fetchone()
+        if one:
+            todo[url] = one[0]
+    logging.info('Fetching %d articles' % len(todo))
+    # daemon threads rather than a ThreadPoolExecutor, whose threads would keep the program from ending until
+    # every article has been fetched
+    work = queue.Queue()
+    for url in todo:
+        work.put(url)
+    done = queue.Queue()
+    def worker():
+        while True:
+            try:
+                url = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put( ( url, fetcharticle(url) ) )
+            except Exception as err:
+                logging.info("Can't fetch the article %s: %s" % ( __blue(url), err ) )
+                done.put( ( url, None ) )
+    for i in range(min(int(args.threads),len(todo))):
+        threading.Thread(target=worker,daemon=True).start()
+    for i in range(len(todo)):
+        url, text = done.get()
+        blob = zlib.compress(text.encode('utf-8')) if text else None
+        try:
+            cur.execute('INSERT OR REPLACE INTO article (itemid, fetchtime, size, text) VALUES (?, ?, ?, ?)', ( todo[url], int(time.time()), len(blob) if blob else 0, blob ) )
+            conn.commit()
+        except sqlite3.Error as err:
+            logging.warning("Can't store the article %s: %s" % ( __blue(url), err ) )
+    evictarticles(cur)
+    conn.commit()
+    conn.close()
+
+def evictarticles(cur):
+    # removes the articles older than --cachedays and then the oldest until they fit in --cachesize
+    cur.execute('DELETE FROM article WHERE fetchtime < %d' % ( int(time.time()) - 86400 * int(args.cachedays) ) )
+    cur.execute('DELETE FROM article WHERE itemid IN (SELECT itemid FROM (SELECT itemid, sum(size) OVER (ORDER BY fetchtime DESC, itemid DESC) AS total FROM article) WHERE total > %d)' % ( int(args.cachesize) * 1024 * 1024 ) )
+
+def getarticle(url):
+    # the text of the article of an item if it has been fetched, None otherwise
+    cur.execute('SELECT article.text FROM item JOIN article ON article.itemid = item.id WHERE item.url = ?', ( url, ) )
+    one = cur.fetchone()
+    return(zlib.decompress(one[0]).decode('utf-8') if one and one[0] else None)
 
 def deleteurl(url):
     cur.execute('SELECT COUNT(*) FROM SOURCE WHERE url="%s";' % url)
     if (cur.fetchone()[0]):
-        cur.execute('SELECT * FROM SOURCE WHERE url="%s";' % url)
+        cur.execute('SELECT url, name FROM SOURCE WHERE url="%s";' % url)
         line = cur.fetchone()
         myprint("Are you sure you want to delete %s (%s) from the reader?" % ( __red(line[1]), __red(line[0]) ) )
         yes = readchar.readchar()
@@ -423,37 +1308,110 @@ def deleteurl(url):
         myprint("Can't find %s in the reader; nothing to delete" % __blue(url))
         return(0)
 
+# the tags used so far and how often, for the completion in bookmark(). The trie has a node for every prefix
+# of a tag; the '' key of a node holds (count, tag) for the most used tag starting with that prefix, so
+# predicting a tag takes one step per character typed. It's built the first time we bookmark something and
+# kept up to date after that, so it isn't read from the database again
+tagcounts = None
+tagtrie = {}
+
+def buildtagindex():
+    global tagcounts
+    tagcounts = {}
+    cur.execute('SELECT tag.tag, tagcount.count FROM tagcount JOIN tag ON tag.id = tagcount.tagid WHERE tagcount.count > 0')
+    for line in cur.fetchall():
+        addtagindex(line[0],line[1])
+
+def addtagindex(tag,n=1):
+    # adds (or, with a negative n, removes) n uses of tag
+    # a tag that is used less doesn't give up its place as the most used tag for a prefix until the index
+    # is built again, which is fine for a prediction
+    count = tagcounts.get(tag,0) + n
+    tagcounts[tag] = count
+    node = tagtrie
+    for c in tag:
+        node = node.setdefault(c,{})
+        best = node.get('')
+        if not best or best[0] < count or best[1] == tag:
+            node[''] = ( count, tag )
+
+def predicttag(prefix):
+    # the most used tag starting with prefix; if there is none, the most used tag that starts with prefix
+    # with one character changed, added or left out, so a typo doesn't stop the completion
+    if not prefix:
+        return('')
+    node = tagtrie
+    for c in prefix:
+        node = node.get(c)
+        if node is None:
+            break
+    else:
+        return(node[''][1])
+    if len(prefix) < 3:
+        return('')
+    found = []
+    def walk(node,i,edits):
+        if i == len(prefix):
+            if '' in node: found.append(node[''])
+            return
+        if prefix[i] in node: walk(node[prefix[i]],i+1,edits)
+        if edits:
+            walk(node,i+1,0) # a character too many
+            for c in node:
+                if c == '': continue
+                walk(node[c],i+1,0) # a wrong character
+                walk(node[c],i,0) # a character left out
+    walk(tagtrie,0,1)
+    return(max(found)[1] if found else '')
+
+def itemtags(url,cur=cur):
+    # the tags of the item with this URL, in the order they were given
+    cur.execute('SELECT tag.tag FROM item JOIN itemtag ON itemtag.itemid = item.id JOIN tag ON tag.id = itemtag.tagid WHERE item.url = ? ORDER BY itemtag.rowid', ( url, ) )
+    return( [ line[0] for line in cur.fetchall() ] )
+
+def settags(url,tags,cur=cur):
+    # gives the item with this URL these tags in place of the ones it had; cur can be a cursor of another
+    # connection, for --serve
+    try:
+        for tag in itemtags(url,cur):
+            if tagcounts is not None: addtagindex(tag,-1)
+        cur.execute('DELETE FROM itemtag WHERE itemid = (SELECT id FROM item WHERE url = ?)', ( url, ) )
+        cur.connection.commit()
+    except:
+        logging.warning('Failed to delete old tags for url %s' % url )
+    for tag in tags:
+        try:
+            cur.execute('INSERT OR IGNORE INTO tag (tag) VALUES (?)', ( tag, ) )
+            cur.execute('INSERT OR IGNORE INTO itemtag (tagid, itemid) SELECT tag.id, item.id FROM tag, item WHERE tag.tag = ? AND item.url = ?', ( tag, url ) )
+            cur.connection.commit()
+            if tagcounts is not None: addtagindex(tag)
+        except:
+            logging.warning("Can't insert (\"%s\",\"%s\") into the database" % ( tag, url ) )
+
 def bookmark(url):
-    cur.execute('SELECT tag FROM tag')
-    conn.commit()
-    tags = cur.fetchall()
-    tagdict = {}
-    for _tag in tags:
-        tag = _tag[0]
-        tagdict[tag] = 1 if not(tag in tagdict) else tagdict[tag]+1
-    sortedtags = sorted(tagdict,key=lambda x: tagdict[x],reverse=True)
+    if tagcounts is None:
+        buildtagindex()
     done = 0
     thesetags = [ ]
     currenttag = ''
     while not(done) :
-        predict = ''
-        for t in sortedtags:
-            if currenttag and t.find(currenttag) == 0:
-                predict = t
-                break
+        predict = predicttag(currenttag)
+        # what we print after what has been typed: the rest of the predicted tag or, if it was found despite
+        # a typo, the whole tag
+        hint = predict[len(currenttag):] if predict.startswith(currenttag) else ' ~' + predict
         # the next dozen lines or so are to print the tags and predictions as we type
         remaining = termwidth - 6 # for Tags
         if len(thesetags) > 10: remaining -= 4
         for t in thesetags[max(len(thesetags)-10,0):]:
             remaining = remaining - 1 - len(t)
         if predict:
-            remaining = remaining - 1 - len(predict)
+            remaining = remaining - 1 - len(currenttag) - len(hint)
         else:
             remaining = remaining - 1 - len(currenttag)
-        backspaces = remaining - len(currenttag) + len(predict)
+        backspaces = remaining + len(hint)
         if not predict: backspaces = remaining
 #        sys.stdout.write( (' ' * ( backspaces ) ) + "\r" )
-        printline =  "\r" + __bold ('Tags:')+ ( ' ... ' if len(thesetags) > 10 else ' ') + ' '.join(map(__magenta,thesetags[max(len(thesetags)-10,0):])) + ( ' ' if len(thesetags) else '' ) + __underline(__magenta(currenttag)) + predict[len(currenttag):] + ( ' ' * remaining )  + ( "\b" * backspaces )
+        printline =  "\r" + __bold ('Tags:')+ ( ' ... ' if len(thesetags) > 10 else ' ') + ' '.join(map(__magenta,thesetags[max(len(thesetags)-10,0):])) + ( ' ' if len(thesetags) else '' ) + __underline(__magenta(currenttag)) + ( hint if predict else '' ) + ( ' ' * remaining )  + ( "\b" * backspaces )
         sys.stdout.write( printline )
         sys.stdout.flush()
         key = readchar.readchar().lower()
@@ -473,17 +1431,7 @@ def bookmark(url):
         elif key == '\r':
             if currenttag:
                 thesetags.append(currenttag)
-            try:
-                cur.execute('DELETE FROM tag WHERE url = "%s"' % url )
-                conn.commit()
-            except:
-                logging.warning('Failed to delete old tags for url %s' % url )
-            for tag in thesetags:
-                try:
-                    cur.execute('INSERT INTO tag VALUES ("%s","%s")' % ( tag, url ) )
-                    conn.commit()
-                except:
-                    logging.warning("Can't insert (\"%s\",\"%s\") into the database" % ( tag, url ) )
+            settags(url,thesetags)
             done = 1
         if ord(key[:1]) == 27: #escape key
             return(0)
@@ -491,84 +1439,74 @@ def bookmark(url):
     
 def findtags(*tags):
     # find all the URLs mathings _all_ the tags
-    cur.execute('SELECT * FROM tag')
-    conn.commit
-    urltags = cur.fetchall()
-    urls = {}
-    for ut in urltags:
-        t = ut[0]
-        u = ut[1]
-        if not(u in urls): urls[u] = set()
-        urls[u].add(t)
-    foundurls = []
-    for u in urls:
-        if set(tags[0]).issubset(urls[u]):
-            try:
-                cur.execute('SELECT * FROM item WHERE url = "%s"' % u)
-                conn.commit
-                line = cur.fetchone()
-                foundurls.append( { 'url' : u, 'time' : line[2] , 'title' : line[5], 'description': line[7] } )
-            except:
-                logging.warning('Something went wrong. Found tags for %s but this URL is not found in items' % u)
-    sortedurls = sorted(foundurls,key=lambda x: x['time'],reverse=(False if sortorder == 'ASC' else True))
-    count = 0
-    for u in sortedurls:
-        count = count+1
-        if (limit > 0 and count > limit): break
-        thesetags = []
-        cur.execute('SELECT * FROM tag WHERE url = "%s"' % u['url'])
-        conn.commit
-        for l in cur.fetchall():
-            thesetags.append(l[0])
-        if shortfind:
-            myprint("%s: %s" % ( __blue(datetime.datetime.fromtimestamp(u['time']).strftime("%B %d, %Y")),__bold(u['title'])) )
-            myprint("%s" % u['url'])
-        else:
-            myprint("%s" % __bold(u['title']))
-            myprint("%s\t%s" % ( __blue(time.ctime(u['time'])) , __magenta(' '.join(thesetags)) ))
-            myprint("%s" % u['url'])
+    tags = set(tags[0])
+    cur.execute('SELECT item.url, item.time, item.title FROM item JOIN itemtag ON itemtag.itemid = item.id JOIN tag ON tag.id = itemtag.tagid WHERE tag.tag IN (%s) GROUP BY item.id HAVING count(*) = %d ORDER BY item.time %s LIMIT %d' % ( ','.join('?' * len(tags)), len(tags), sortorder, limit if limit > 0 else -1 ), list(tags) )
+    printfound(cur.fetchall())
     return(1)
 
 def findortags(*tags):
     # find all the URLs mathings at least one of the tags
-    ortags = '" OR tag="'.join(list(tags[0]))
-    cur.execute('SELECT * FROM tag WHERE tag="' + ortags + '"')
-    conn.commit
-    urltags = cur.fetchall()
-    urls = {}
-    for ut in urltags:
-        t = ut[0]
-        u = ut[1]
-        if not(u in urls): urls[u] = set()
-        urls[u].add(t)
-    foundurls = []
-    for u in urls:
-#        if set(tags[0]).issubset(urls[u]):
-            try:
-                cur.execute('SELECT * FROM item WHERE url = "%s"' % u)
-                conn.commit
-                line = cur.fetchone()
-                foundurls.append( { 'url' : u, 'time' : line[2] , 'title' : line[5], 'description': line[7] } )
-            except:
-                logging.warning('Something went wrong. Found tags for %s but this URL is not found in items' % u)
-    sortedurls = sorted(foundurls,key=lambda x: x['time'],reverse=(False if sortorder == 'ASC' else True))
-    count = 0
-    for u in sortedurls:
-        count = count+1
-        if (limit > 0 and count > limit): break
-        thesetags = []
-        cur.execute('SELECT * FROM tag WHERE url = "%s"' % u['url'])
-        conn.commit
-        for l in cur.fetchall():
-            thesetags.append(l[0])
+    tags = set(tags[0])
+    cur.execute('SELECT item.url, item.time, item.title FROM item JOIN itemtag ON itemtag.itemid = item.id JOIN tag ON tag.id = itemtag.tagid WHERE tag.tag IN (%s) GROUP BY item.id ORDER BY item.time %s LIMIT %d' % ( ','.join('?' * len(tags)), sortorder, limit if limit > 0 else -1 ), list(tags) )
+    printfound(cur.fetchall())
+    return(1)
+
+def printfound(rows):
+    # prints the (url, time, title) rows found by findtags or findortags
+    for url, itemtime, title in rows:
         if shortfind:
-            myprint("%s: %s" % ( __blue(datetime.datetime.fromtimestamp(u['time']).strftime("%B %d, %Y")),__bold(u['title'])) )
-            myprint("%s" % u['url'])
+            myprint("%s: %s" % ( __blue(datetime.datetime.fromtimestamp(itemtime).strftime("%B %d, %Y")),__bold(title)) )
+            myprint("%s" % url)
         else:
-            myprint("%s" % __bold(u['title']))
-            myprint("%s\t%s" % ( __blue(time.ctime(u['time'])) , __magenta(' '.join(thesetags)) ))
-            myprint("%s" % u['url'])
-    return(1)
+            myprint("%s" % __bold(title))
+            myprint("%s\t%s" % ( __blue(time.ctime(itemtime)) , __magenta(' '.join(itemtags(url))) ))
+            myprint("%s" % url)
+
+# the tags of an item as one string, separated by spaces and in the order they were given, for a query that
+# selects from item: a subquery through the index on itemtag, so the tags of every row don't take a query of their own
+itemtagsquery = "( SELECT group_concat(tag, ' ') FROM ( SELECT tag.tag FROM itemtag JOIN tag ON tag.id = itemtag.tagid WHERE itemtag.itemid = item.id ORDER BY itemtag.rowid ) )"
+
+# the columns of --export, in this order in the CSV
+exportfields = ['url', 'title', 'author', 'time', 'addtime', 'readtime', 'saved', 'tags', 'source', 'sourceurl', 'weight', 'description']
+exportbatch = 1000
+
+def exportitems(filename,tags=None,orfind=False,state=None,since=None,until=None):
+    # writes the items to filename as JSON Lines or CSV. The rows come from the cursor exportbatch at a time
+    # and go straight to the file, so the archive is never in memory as a whole
+    where = [ 'coalesce(source.weight,5) >= %d AND coalesce(source.weight,5) <= %d' % ( minweight, maxweight ) ]
+    params = [ ]
+    if state == 'read': where.append('item.readtime > 0')
+    if state == 'unread': where.append('item.readtime = 0')
+    if saved: where.append('item.saved = 1')
+    if since is not None: where.append('item.time >= %d' % since)
+    if until is not None: where.append('item.time < %d' % until)
+    if tags:
+        tags = set(tags)
+        where.append('item.id IN (SELECT itemtag.itemid FROM itemtag JOIN tag ON tag.id = itemtag.tagid WHERE tag.tag IN (%s) GROUP BY itemtag.itemid%s)' % ( ','.join('?' * len(tags)), '' if orfind else ' HAVING count(*) = %d' % len(tags) ))
+        params += list(tags)
+    cur.execute('''SELECT item.url, item.title, item.author, item.time, item.addtime, item.readtime, item.saved, %s,
+        source.name, source.url, source.weight, item.description
+        FROM item LEFT JOIN source ON source.id = item.sourceid WHERE %s ORDER BY item.time %s LIMIT %d''' % ( itemtagsquery, ' AND '.join(where), sortorder, limit if limit > 0 else -1 ), params )
+    count = 0
+    jsonl = not filename.endswith('.csv')
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    f = sys.stdout if filename == '-' else open(filename,'w',newline='',encoding='utf-8',buffering=1<<20)
+    try:
+        if not jsonl:
+            writer = csv.writer(f)
+            writer.writerow(exportfields)
+        while True:
+            rows = cur.fetchmany(exportbatch)
+            if not rows: break
+            if jsonl:
+                f.writelines( encode(dict(zip(exportfields, row[:7] + ( row[7].split(' ') if row[7] else [], ) + row[8:]))) + '\n' for row in rows )
+            else:
+                writer.writerows(rows)
+            count += len(rows)
+    finally:
+        if f is not sys.stdout: f.close()
+    logging.info('Exported %d items to %s' % ( count, filename ) )
+    return(count)
 
 def renamefeed(url,name):
     # rename a feed
@@ -596,100 +1534,79 @@ def adjustweight(url,weight):
 
 def renametags(old,new):
     # rename rags
-    cur.execute('SELECT * FROM tag WHERE tag = "%s"' % new )
-    if len(cur.fetchall()):
+    cur.execute('SELECT id FROM tag WHERE tag = ?', ( new, ) )
+    one = cur.fetchone()
+    if one:
         myprint("Entries tagged as %s already exist. Are you sure you want to rename tags '%s' as '%s' too? You can't separate them afterwards!" % ( new, old, new ) )
         yes = readchar.readchar()
         if yes.lower() != 'y':
             quit()
     myprint('Okay then...')
     try:
-        cur.execute('UPDATE tag SET tag = "%s" WHERE tag = "%s"' % ( new, old ))
+        if one:
+            # the items get the existing tag and the old one goes
+            cur.execute('INSERT OR IGNORE INTO itemtag (tagid, itemid) SELECT ?, itemid FROM itemtag WHERE tagid = (SELECT id FROM tag WHERE tag = ?)', ( one[0], old ) )
+            cur.execute('DELETE FROM itemtag WHERE tagid = (SELECT id FROM tag WHERE tag = ?)', ( old, ) )
+            cur.execute('DELETE FROM tag WHERE tag = ?', ( old, ) )
+        else:
+            cur.execute('UPDATE tag SET tag = ? WHERE tag = ?', ( new, old ) )
         conn.commit()
     except:
         logging.error("Couldn't change the tag")
     quit()
 
 def displayrecent(number):
-    cur.execute('SELECT * FROM item ORDER BY readtime DESC LIMIT %d' % num )
-    conn.commit()
-    rows = cur.fetchall()
-    for line in rows:
-        url = line[0]
-        source = line[1]
-        title = line[5]
-        match = re.search('<a [^>]*>([^<]*)</a>',title)
-        if match: title = match.group(1)
-        author = line[6]
-        if author: author = ' (' + author + ')'
-        itemtime = time.ctime(line[2])
-        sourcename = ''
-        cur.execute( 'SELECT * FROM source WHERE url = "%s"' % source )
-        one = cur.fetchone()
-        if one:
-            sourcename = __red(one[1]) + ' : '
-        myprint('%s%s%s %s' % ( sourcename, __blue(title) , author, itemtime ) )
-        myprint(url)
-        tags = []
-        cur.execute( 'SELECT * FROM tag WHERE url = "%s"' % url )
-        r = cur.fetchall()
-        for l in r:
-            tags.append(l[0])
-        if(len(tags)):
-            myprint(__bold('Tags: ' ) + ' '.join(map(__magenta,tags)))
-        myprint('')
-    quit()
+    # the items read last, with their source and tags, in one query
+    cur.execute('SELECT item.url, source.name, item.time, item.title, item.author, %s FROM item LEFT JOIN source ON source.id = item.sourceid ORDER BY item.readtime DESC LIMIT %d' % ( itemtagsquery, number ) )
+    printrecent(cur.fetchall())
 
 def displayrecentsaved(number):
-    cur.execute('SELECT DISTINCT item.url,item.source,item.title,item.author,item.time FROM item,tag WHERE item.url = tag.url ORDER BY readtime DESC LIMIT %d' % num )
-    conn.commit()
-    rows = cur.fetchall()
-    for line in rows:
-        url = line[0]
-        source = line[1]
-        title = line[2]
+    # the tagged items read last, with their source and tags, in one query
+    cur.execute('SELECT item.url, source.name, item.time, item.title, item.author, %s FROM item LEFT JOIN source ON source.id = item.sourceid WHERE EXISTS (SELECT 1 FROM itemtag WHERE itemtag.itemid = item.id) ORDER BY item.readtime DESC LIMIT %d' % ( itemtagsquery, number ) )
+    printrecent(cur.fetchall())
+
+def printrecent(rows):
+    # prints the (url, source name, time, title, author, tags) rows found by displayrecent or displayrecentsaved
+    for url, sourcename, itemtime, title, author, tags in rows:
         match = re.search('<a [^>]*>([^<]*)</a>',title)
         if match: title = match.group(1)
-        author = line[3]
         if author: author = ' (' + author + ')'
-        itemtime = time.ctime(line[4])
-        sourcename = ''
-        cur.execute( 'SELECT * FROM source WHERE url = "%s"' % source )
-        one = cur.fetchone()
-        if one:
-            sourcename = __red(one[1]) + ' : '
-        myprint('%s%s%s %s' % ( sourcename, __blue(title) , author, itemtime ) )
+        sourcename = __red(sourcename) + ' : ' if sourcename is not None else ''
+        myprint('%s%s%s %s' % ( sourcename, __blue(title) , author, time.ctime(itemtime) ) )
         myprint(url)
-        tags = []
-        cur.execute( 'SELECT * FROM tag WHERE url = "%s"' % url )
-        r = cur.fetchall()
-        for l in r:
-            tags.append(l[0])
-        if(len(tags)):
-            myprint(__bold('Tags: ' ) + ' '.join(map(__magenta,tags)))
+        if tags:
+            myprint(__bold('Tags: ' ) + ' '.join(map(__magenta,tags.split(' '))))
         myprint('')
-    quit()
 
 def markunread(url):
     try:
-        cur.execute('UPDATE item SET readtime = 0 WHERE url = "%s"' % url )
+        cur.execute('UPDATE item SET readtime = 0 WHERE urlkey = ?', ( urlkey(url), ) )
         conn.commit()
+        if not cur.rowcount:
+            logging.warning('There is no item %s' % url )
+            return
         logging.info('Marked %s as unread' % url )
     except sqlite3.Error as err:
         logging.error('Failed to mark %s as unread: %s' % ( url, err ) )
 
 def markread(url):
     try:
-        cur.execute('UPDATE item SET readtime = %d WHERE url = "%s"' % ( int(time.time()), url ) )
+        cur.execute('UPDATE item SET readtime = ? WHERE urlkey = ?', ( int(time.time()), urlkey(url) ) )
         conn.commit()
+        if not cur.rowcount:
+            logging.warning('There is no item %s' % url )
+            return
         logging.info('Marked %s as read' % url )
     except sqlite3.Error as err:
         logging.error('Failed to mark %s as read: %s' % ( url, err ) )
 
 def marksaved(url):
     try:
-        cur.execute('UPDATE item SET saved = 1 WHERE url = "%s"' % url )
+        cur.execute('UPDATE item SET saved = 1 WHERE urlkey = ?', ( urlkey(url), ) )
         conn.commit()
+        if not cur.rowcount:
+            logging.warning('There is no item %s' % url )
+            return
         logging.info('Marked %s as saved' % url )
     except sqlite3.Error as err:
         logging.error('Failed to mark %s as read: %s' % ( url, err ) )
@@ -726,23 +1643,46 @@ if (args.addcsv):
     quit()
   
 if (args.list):
-    listurls()
+    with phase('query'), listing():
+        listurls()
     quit()
 
-if (args.listtags):
-    listtags(limit)
+if (args.listtags is not None):
+    with phase('query'), listing():
+        listtags(limit,args.listtags,args.since,args.until)
+    quit()
+
+if (args.export):
+    with phase('query'):
+        exportitems(args.export,list(map(lambda x:x.lower(),args.find)) if args.find else None,args.orfind,args.state,args.since,args.until)
+    quit()
+
+if (args.worker is not None):
+    with phase('fetch'):
+        work()
+    quit()
+
+if (args.reparse):
+    with phase('fetch'):
+        reparse()
     quit()
 
 if (args.update):
-    updateurls()
+    with phase('fetch'):
+        updateurls()
+        if args.prefetch:
+            cur.execute( "SELECT url FROM item WHERE readtime = 0 AND saved = 0 ORDER BY time %s LIMIT %d" % ( sortorder, args.prefetch ) )
+            prefetcharticles([ line[0] for line in cur.fetchall() ])
     quit()
 
 if (args.find and args.orfind):
-    findortags(list(map(lambda x:x.lower(),args.find)))
+    with phase('query'), listing():
+        findortags(list(map(lambda x:x.lower(),args.find)))
     quit()
 
 if (args.find and not args.website):
-    findtags(list(map(lambda x:x.lower(),args.find)))
+    with phase('query'), listing():
+        findtags(list(map(lambda x:x.lower(),args.find)))
     quit()
 
 if (args.delete):
@@ -772,13 +1712,15 @@ if (args.renametag):
 if (args.recent and not args.website):
     num = int(args.limit)
     if num == 0: num = 10
-    displayrecent(num)
+    with phase('query'), listing():
+        displayrecent(num)
     quit()
 
 if (args.recentsaved and not args.website):
     num = int(args.limit)
     if num == 0: num = 10
-    displayrecentsaved(num)
+    with phase('query'), listing():
+        displayrecentsaved(num)
     quit()
 
 def gettitle(url):
@@ -798,10 +1740,9 @@ def statistics():
         now = int(time.time())
         cur.execute('SELECT count(*) FROM item')
         numitems = cur.fetchone()[0]
-        cur.execute('SELECT count(*) FROM tag')
-        numtags = cur.fetchone()[0]
-        cur.execute('SELECT count(DISTINCT tag) FROM tag')
-        numuniqtags = cur.fetchone()[0]
+        cur.execute('SELECT total(count), count(*) FROM tagcount WHERE count > 0')
+        numtags, numuniqtags = cur.fetchone()
+        numtags = int(numtags)
         cur.execute('SELECT count(*) FROM source')
         numsources = cur.fetchone()[0]
         cur.execute('SELECT count(*) FROM source WHERE lastupdated > 0')
@@ -823,13 +1764,26 @@ if (args.addurl):
         title = gettitle(url)
         if not title:
             continue
+        now = int(time.time())
+        try:
+            # an item we have under another variant of the URL is the one bookmarked
+            cur.execute('SELECT url FROM item WHERE urlkey = ?', ( urlkey(url), ) )
+            one = cur.fetchone()
+            existed = one is not None
+            url = one[0] if one else url
+            cur.execute('INSERT OR IGNORE INTO item ( url, urlkey, sourceid, title, time, addtime, readtime, saved ) VALUES (?, ?, NULL, ?, ?, ?, ?, 0)', ( url, urlkey(url), title, now, now, now ) )
+            conn.commit()
+        except sqlite3.Error as err:
+            logging.error('Cannot insert %s ("%s") into database: %s' % ( url, title , err ) )
+            continue
         if not bookmark(url):
+            if not existed:
+                cur.execute('DELETE FROM item WHERE url = ?', ( url, ) )
+                conn.commit()
             continue
         print("Bookmarked '%s' (%s)" % (title,url))
-        now = int(time.time())
         try:
-            cur.execute('DELETE FROM item WHERE url = "%s"' % url )
-            cur.execute('INSERT INTO item ( url, source, title, time, addtime, readtime, saved ) VALUES ("%s", "", "%s", "%d", "%d", "%d", 0 ) ' % ( url, title, now, now, now ))
+            cur.execute('UPDATE item SET sourceid = NULL, title = ?, time = ?, addtime = ?, readtime = ?, saved = 0, author = NULL, description = ? WHERE url = ?', ( title, now, now, now, '', url ) )
             conn.commit()
         except sqlite3.Error as err:
             logging.error('Cannot insert %s ("%s") into database: %s' % ( url, title , err ) )
@@ -852,56 +1806,60 @@ if (args.read):
     quit()
 
 if (args.statistics):
-    statistics()
+    with phase('query'):
+        statistics()
     quit()
 
-##### TEMP #####
-if (args.tempimport):
-    dbfile2 = args.tempimport
-    conn2 = sqlite3.connect(dbfile2)
-    cur2 = conn2.cursor()
-    cur2.execute("SELECT * FROM entry")
-    rows = cur2.fetchall()
+if (args.merge):
+    with phase('query'):
+        mergedb(args.merge)
+    quit()
+
+def itemsfromrows(rows,cur=cur):
+    # turns rows from the item table, which are url, sourceid, time, readtime, addtime, title, author, description
+    # and the cluster (the id of the item for one without near-duplicates), into Items with the name and weight
+    # of their source, leaving out those outside the weight range. The first item of a cluster stands for the
+    # others, which are left out. cur can be a cursor of another connection, for --serve
+    sources = {}
+    cur.execute('SELECT id, name, weight FROM source')
+    for line in cur.fetchall():
+        sources[line[0]] = ( line[1], line[2] )
+    items = []
+    clusters = {}
     for line in rows:
-        url = line[0]
-        source = ''
-        time_ = line[1]
-        readtime = 0
-        addtime = int(time.time()) # now
-        title = line[2]
+        if line[8] in clusters:
+            clusters[line[8]].append(line[0])
+            continue
+        title = line[5]
         match = re.search('<a [^>]*>([^<]*)</a>',title)
         if match: title = match.group(1)
-        author = ''
-        summary = ''
-        saved = 0
-        cur2.execute('SELECT * FROM read WHERE url = "%s"' % url )
-        one = cur2.fetchone()
-        if one:
-            readtime = one[1]
-            addtime = one[2]
-            source = one[3]
-            title = one[4]
-        cur2.execute('SELECT * FROM tag WHERE url = "%s"' % url )
-        r = cur2.fetchall()
-        cur.execute('DELETE FROM tag WHERE url = "%s"' % url )
-        for l in r:
-            cur.execute('REPLACE INTO tag ( tag , url ) VALUES ( "%s", "%s" )' % ( l[0] , url ) )
-        cur.execute('REPLACE INTO item (url, source, time, readtime, addtime, title, author, description, saved) VALUES ("%s", "%s", %d , %d, %d, "%s", "%s", "%s" , %d);' % ( url , source , time_ , readtime , addtime , title, author, summary , saved ))
-        conn.commit()
-        logging.info('Added "%s" (%s) to the new database' % ( __magenta( title ) , __blue( url ) ) )
-    quit()
-#### END TEMP ####
+        # there usually is a matching source, but maybe a source has since been deleted
+        source, weight = sources.get(line[1], ( '', 5 ) )
+        if weight < minweight: continue
+        if weight > maxweight: continue
+        items.append( Item( line[0], source, line[2], title, line[6], line[7], weight ) )
+        clusters[line[8]] = [ ]
+    return([ item._replace(others=tuple(others)) if others else item for item, others in zip(items,clusters.values()) ])
 
-if (args.website):
-    if args.recentsaved:
-        cur.execute('SELECT DISTINCT item.url,item.source,item.time,item.readtime,item.addtime,item.title,item.author,item.description FROM item,tag WHERE item.url = tag.url ORDER BY item.readtime DESC LIMIT %d' % ( int(args.limit) if args.limit else 10 ) )
-    elif args.recent:
-        cur.execute('SELECT item.url,item.source,item.time,item.readtime,item.addtime,item.title,item.author,item.description FROM item ORDER BY readtime DESC LIMIT %d' % int(args.limit) )
-    elif args.find:
-        cur.execute('SELECT DISTINCT item.url,item.source,item.time,item.readtime,item.addtime,item.title,item.author,item.description FROM item,tag WHERE item.url = tag.url AND tag.tag = "%s" ORDER BY item.readtime DESC LIMIT %d' % ( args.find[0], int(args.limit) if args.limit else 10 ) )
-    else:
-        cur.execute( "SELECT * FROM item WHERE readtime = 0 AND saved = %d ORDER BY time %s" % ( saved , sortorder ) )
-    rows = cur.fetchall()
+def terminaltext(content):
+    # some HTML entities that don't print on the terminal
+    # there will be many others, but these appear to be the most common
+    content = re.sub('&#8211;','--',content)
+    content = re.sub('&#8212;','---',content)
+    content = re.sub('&#8216;',"'",content)
+    content = re.sub('&#8217;',"'",content)
+    content = re.sub('&#8220;','"',content)
+    content = re.sub('&#8221;','"',content)
+    content = re.sub('&#8230;','...',content)
+    # next two lines remove HTML tags from the summary
+    clean = re.compile('<.*?>') 
+    content = re.sub(clean,'',content)
+    return(content)
+
+def website(rows,cur=cur,footer='',api=False):
+    # returns the HTML page with the given items, and footer after them. The buttons of a page served by --serve
+    # (api) post to its API; those of a static page call rssweb.py. Everything that comes from a feed is escaped,
+    # so a feed can't put a script on the page
     output = '''<html>
 <head>
 <title>RSSCLI output</title>
@@ -930,111 +1888,301 @@ xmlhttp.onreadystatechange=function() {
 <main role="main">
 <div class="container">
 '''
+    call = "$.post('/api/%s', { url: decodeURIComponent('%s') });" if api else "$.get('/rss/rssweb.py?action=%s&url=%s');"
     counter = 0
-    for line in rows:
-        url = line[0]
-        itemtime = line[2]
-        title = line[5]
-        match = re.search('<a [^>]*>([^<]*)</a>',title)
-        if match: title = match.group(1)
-        author = line[6]
+    for url, source, itemtime, title, author, content, weight, others in itemsfromrows(rows,cur):
+        source = html.escape(source or '')
+        title = html.escape(title or '')
+        author = html.escape(author or '')
         if author: author += ', '
-        content = re.sub('[\n\r]','',line[7])
+        also = ' &middot; also in %d other source%s' % ( len(others), 's' if len(others) > 1 else '' ) if others else ''
+        content = re.sub('[\n\r]','',content)
         content = re.sub(' +>','>',content)
         content = re.sub('  +',' ',content)
-        content = remove_html_tags(content)
+        content = html.escape(html.unescape(remove_html_tags(content)))
         contentsplit = content.split(' ')
         if len(contentsplit) > 100:
             content = ' '.join(contentsplit[:100]) + ' ...'
-        weight = 5
-        source = line[1]
-        cur.execute( 'SELECT * FROM source WHERE url = "%s"' % source )
-        one = cur.fetchone()
-        # this is when there is a matching source. There usually is, but maybe a source has since been deleted
-        if one:
-            weight = one[4]
-            source = one[1]
-        if weight < minweight: continue
-        if weight > maxweight: continue
         output += f'''<div id="block{counter}" class="collapse show blog-post"><h2 class="blog-post-title">{source} : {title}</h2>
-<p class="blog-post-meta">{author}{time.ctime(itemtime)}</p>
+<p class="blog-post-meta">{author}{time.ctime(itemtime)}{also}</p>
 <p>{content}</p>
-<a class="btn btn-secondary" href="{url}" target="_blank">Read &raquo;</a>
-<button class="btn btn-success" onclick="$.get('/rss/rssweb.py?url={urllib.parse.quote(url)}&action=save');" type="button" data-toggle="collapse" data-target="#block{counter}" aria-expanded="true" aria-controls="block{counter}">Save &#10071;</button>
-<button class="btn btn-danger" onclick="$.get('/rss/rssweb.py?url={urllib.parse.quote(url)}&action=markread');" type="button" data-toggle="collapse" data-target="#block{counter}" aria-expanded="true" aria-controls="block{counter}">Delete &#10060;</button>
+<a class="btn btn-secondary" href="{html.escape(url)}" target="_blank">Read &raquo;</a>
+<button class="btn btn-success" onclick="{call % ( 'save', urllib.parse.quote(url) )}" type="button" data-toggle="collapse" data-target="#block{counter}" aria-expanded="true" aria-controls="block{counter}">Save &#10071;</button>
+<button class="btn btn-danger" onclick="{call % ( 'markread', urllib.parse.quote(url) )}" type="button" data-toggle="collapse" data-target="#block{counter}" aria-expanded="true" aria-controls="block{counter}">Delete &#10060;</button>
 <br/><br/>
 </div>
 
 ''' 
 #        if counter %  3 == 2: output += '</div>\n<hr/>\n<div class="row">'
         counter += 1
-    output += '''</div>
+    output += footer + '''</div>
 </main>
 </body>
 </html>'''
-    f = open(args.website[0],'w')
-    f.write(output)
+    return(output)
+
+if (args.website):
+    with phase('query'):
+        if args.recentsaved:
+            cur.execute('SELECT item.url,item.sourceid,item.time,item.readtime,item.addtime,item.title,item.author,item.description,coalesce(item.cluster,item.id) FROM item WHERE EXISTS (SELECT 1 FROM itemtag WHERE itemtag.itemid = item.id) ORDER BY item.readtime DESC LIMIT %d' % ( int(args.limit) if args.limit else 10 ) )
+        elif args.recent:
+            cur.execute('SELECT item.url,item.sourceid,item.time,item.readtime,item.addtime,item.title,item.author,item.description,coalesce(item.cluster,item.id) FROM item ORDER BY item.readtime DESC LIMIT %d' % ( int(args.limit) if args.limit else 10 ) )
+        elif args.find:
+            cur.execute('SELECT item.url,item.sourceid,item.time,item.readtime,item.addtime,item.title,item.author,item.description,coalesce(item.cluster,item.id) FROM item JOIN itemtag ON itemtag.itemid = item.id JOIN tag ON tag.id = itemtag.tagid WHERE tag.tag = ? ORDER BY item.readtime DESC LIMIT %d' % ( int(args.limit) if args.limit else 10 ), ( args.find[0], ) )
+        else:
+            cur.execute( "SELECT url, sourceid, time, readtime, addtime, title, author, description, coalesce(cluster,id) FROM item WHERE readtime = 0 AND saved = %d ORDER BY time %s" % ( saved , sortorder ) )
+        rows = cur.fetchall()
+    with phase('render'):
+        output = website(rows)
+        f = open(args.website[0],'w')
+        f.write(output)
     quit()
 
-    
+# --serve: a server that lives as long as the program, so a click on the website is an UPDATE rather than a new
+# Python process. The event loop only reads and writes HTTP; the database work is done in a few threads, each
+# taking one of the connections in dbpool while it works
+servethreads = 4
+
+def servepage(cur,view,page):
+    # the rows of page page of the unread or saved items, and whether there is a next page. A page has -n clusters
+    # of near-duplicates in the weight range: their first items, in order, and then the rest of their items, so
+    # itemsfromrows makes one Item of every cluster
+    size = int(args.limit) if args.limit else 50
+    where = 'item.readtime = 0 AND item.saved = %d AND coalesce(source.weight,5) >= %d AND coalesce(source.weight,5) <= %d' % ( 1 if view == 'saved' else 0, minweight, maxweight )
+    order = 'item.time %s, item.id' % sortorder
+    cur.execute( "SELECT item.url, item.sourceid, item.time, item.readtime, item.addtime, item.title, item.author, item.description, first.clusterid FROM ( SELECT id, time, clusterid FROM ( SELECT item.id, item.time, coalesce(item.cluster,item.id) AS clusterid, row_number() OVER ( PARTITION BY coalesce(item.cluster,item.id) ORDER BY %s ) AS n FROM item LEFT JOIN source ON source.id = item.sourceid WHERE %s ) AS item WHERE n = 1 ORDER BY %s LIMIT %d OFFSET %d ) AS first JOIN item ON item.id = first.id ORDER BY %s" % ( order, where, order, size + 1, page * size, order ) )
+    rows = cur.fetchall()
+    more = len(rows) > size
+    rows = rows[:size]
+    clusters = [ line[8] for line in rows ]
+    if clusters:
+        cur.execute( "SELECT item.url, item.sourceid, item.time, item.readtime, item.addtime, item.title, item.author, item.description, coalesce(item.cluster,item.id) FROM item LEFT JOIN source ON source.id = item.sourceid WHERE %s AND coalesce(item.cluster,item.id) IN (%s) AND item.url NOT IN (%s) ORDER BY %s" % ( where, ','.join('?' * len(clusters)), ','.join('?' * len(rows)), order ), clusters + [ line[0] for line in rows ] )
+        rows += cur.fetchall()
+    return( rows, more )
+
+def servehtml(cur,view,page):
+    rows, more = servepage(cur,view,page)
+    footer = '<nav><ul class="pagination">'
+    if page:
+        footer += '<li class="page-item"><a class="page-link" href="/%s?page=%d">&laquo; Previous</a></li>' % ( view, page - 1 )
+    if more:
+        footer += '<li class="page-item"><a class="page-link" href="/%s?page=%d">Next &raquo;</a></li>' % ( view, page + 1 )
+    footer += '</ul></nav>\n'
+    return( 200, 'text/html; charset=utf-8', website(rows,cur,footer,api=True) )
+
+def serveitems(cur,view,page):
+    rows, more = servepage(cur,view,page)
+    return( 200, { 'page' : page, 'next' : more, 'items' : [ item._asdict() for item in itemsfromrows(rows,cur) ] } )
+
+def serveaction(cur,action,params):
+    # save, markread or tag the item with the URL in params; the statements stay the same, so SQLite can use
+    # the ones it has prepared before
+    url = params.get('url','')
+    cur.execute('SELECT coalesce(cluster,id) FROM item WHERE url = ?', ( url, ) )
+    one = cur.fetchone()
+    if not one:
+        return( 404, { 'ok' : False, 'error' : 'no item with this URL' } )
+    if action == 'save':
+        cur.execute('UPDATE item SET saved = 1 WHERE url = ?', ( url, ) )
+    elif action == 'markread':
+        # with the rest of its cluster, which the website didn't show
+        cur.execute('UPDATE item SET readtime = ? WHERE readtime = 0 AND ( id = ? OR cluster = ? )', ( int(time.time()), one[0], one[0] ) )
+    elif action == 'tag':
+        tags = [ tag for tag in re.split('[ ,]+',params.get('tags','').lower()) if tag ]
+        settags(url,tags,cur)
+        return( 200, { 'ok' : True, 'tags' : tags } )
+    else:
+        return( 404, { 'ok' : False, 'error' : 'no such action' } )
+    cur.connection.commit()
+    return( 200, { 'ok' : True, 'changed' : cur.rowcount } )
+
+def serve(port):
+    dbpool = queue.Queue()
+    for i in range(servethreads):
+        c = sqlite3.connect(dburl, uri=True, timeout=15, check_same_thread=False)
+        c.execute('PRAGMA synchronous = NORMAL')
+        dbpool.put(c)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=servethreads)
+
+    def withdb(function,*a):
+        c = dbpool.get()
+        try:
+            return(function(c.cursor(),*a))
+        finally:
+            dbpool.put(c)
+
+    # the server only answers requests for itself, so another site can't reach it through its own host name, and
+    # only takes actions posted by the website itself or by programs, which don't send an Origin
+    hosts = [ '127.0.0.1:%d' % port, 'localhost:%d' % port ]
+    origins = [ 'http://' + host for host in hosts ]
+
+    def error(status,message):
+        return( status, 'application/json', json.dumps({ 'ok' : False, 'error' : message }) )
+
+    async def route(method,target,headers,body):
+        # returns the status, the content type and the content of the answer
+        path, x, query = target.partition('?')
+        if headers.get('host') not in hosts:
+            return(error(400,'wrong host'))
+        params = dict(urllib.parse.parse_qsl(query))
+        if method == 'POST' and body:
+            try:
+                if 'json' in headers.get('content-type',''):
+                    posted = json.loads(body)
+                else:
+                    posted = dict(urllib.parse.parse_qsl(body.decode('utf-8'),strict_parsing=True))
+            except ValueError:
+                return(error(400,'the body is not valid JSON or form data'))
+            if not isinstance(posted,dict):
+                return(error(400,'the body is not a JSON object'))
+            params.update(posted)
+        try:
+            page = max(int(params.get('page',0)),0)
+        except ValueError:
+            page = 0
+        view = params.get('view','saved' if path == '/saved' else 'unread')
+        loop = asyncio.get_running_loop()
+        if path in ( '/', '/unread', '/saved' ):
+            return(await loop.run_in_executor(executor,withdb,servehtml,path.strip('/') or 'unread',page))
+        if path == '/api/items':
+            status, answer = await loop.run_in_executor(executor,withdb,serveitems,view,page)
+        elif path.startswith('/api/'):
+            # actions change the database, so they can't be a link or an image on another site
+            if method != 'POST':
+                return(error(405,'actions have to be posted'))
+            if headers.get('origin',origins[0]) not in origins:
+                return(error(403,'actions can only come from this website'))
+            if not isinstance(params.get('url',''),str) or not isinstance(params.get('tags',''),str):
+                return(error(400,'url and tags have to be strings'))
+            status, answer = await loop.run_in_executor(executor,withdb,serveaction,path[5:],params)
+        else:
+            status, answer = 404, { 'ok' : False, 'error' : 'not found' }
+        return( status, 'application/json', json.dumps(answer) )
+
+    async def handle(reader,writer):
+        # one connection, with as many requests as the browser sends over it
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line.strip() == b'':
+                        break
+                    name, x, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length',0)))
+                try:
+                    status, contenttype, content = await route(method,target,headers,body)
+                except Exception as err:
+                    logging.error('Error answering %s %s: %s' % ( method, target, err ) )
+                    status, contenttype, content = error(500,'internal error')
+                content = content.encode('utf-8')
+                keepalive = version == 'HTTP/1.1' and headers.get('connection','').lower() != 'close'
+                writer.write(( 'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n' % ( status, 'OK' if status == 200 else 'Error', contenttype, len(content), 'keep-alive' if keepalive else 'close' ) ).encode('latin-1') + content)
+                await writer.drain()
+                logging.info('%s %s %d' % ( method, target, status ) )
+                if not keepalive:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle,'127.0.0.1',port)
+        myprint('Serving the website on http://127.0.0.1:%d/' % port)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+if (args.serve):
+    serve(args.serve)
+    quit()
+
+# the reader doesn't write whether items are read, unread or saved as the keys are pressed, but queues the
+# changes; a thread writes what has been queued in one transaction every second or so, and writes what is left
+# when the program ends, so going to the next headline never waits for the disk
+statequeue = queue.Queue()
+statewriter = None
+
+def writestate():
+    # we need our own connection, because we'll operate inside a thread!
+    conn = sqlite3.connect(dburl, uri=True, timeout=15)
+    conn.execute('PRAGMA synchronous = NORMAL')
+    cur = conn.cursor()
+    done = False
+    while not done:
+        batch = [ statequeue.get() ]
+        deadline = time.monotonic() + 1
+        while batch[-1] is not None:
+            try:
+                batch.append(statequeue.get(timeout=max(deadline - time.monotonic(),0)))
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            # the program is ending
+            batch.pop()
+            done = True
+        try:
+            with conn:
+                for query, params in batch:
+                    cur.execute(query, params)
+            logging.debug('Saved the state of %d items' % len(batch))
+        except sqlite3.Error as err:
+            logging.warning("Couldn't save the state of %d items: %s" % ( len(batch), err ) )
+    conn.close()
+
+def setstate(query,*params):
+    # queues an update of an item, starting the thread that writes them the first time
+    global statewriter
+    if statewriter is None:
+        statewriter = threading.Thread(target=writestate,daemon=True)
+        statewriter.start()
+        atexit.register(flushstate)
+    statequeue.put( ( query, params ) )
+
+def flushstate():
+    # writes what is still queued before the program ends
+    statequeue.put(None)
+    statewriter.join()
+
 # MAIN LOOP
 # this runs when no other function is run
-cur.execute( "SELECT * FROM item WHERE readtime = 0 AND saved = %d ORDER BY time %s" % ( saved , sortorder ) )
-rows = cur.fetchall()
-entries = []
-for line in rows:
-    url = line[0]
-    itemtime = line[2]
-    title = line[5]
-    match = re.search('<a [^>]*>([^<]*)</a>',title)
-    if match: title = match.group(1)
-    author = line[6]
-    content = line[7]
-    weight = 5
-    source = line[1]
-    cur.execute( 'SELECT * FROM source WHERE url = "%s"' % source )
-    one = cur.fetchone()
-    # this is when there is a matching source. There usually is, but maybe a source has since been deleted
-    if one:
-        weight = one[4]
-        source = one[1]
-    if weight < minweight: continue
-    if weight > maxweight: continue
-    # some HTML entities that don't print on the terminal
-    # there will be many others, but these appear to be the most common
-    content = re.sub('&#8211;','--',content)
-    content = re.sub('&#8212;','---',content)
-    content = re.sub('&#8216;',"'",content)
-    content = re.sub('&#8217;',"'",content)
-    content = re.sub('&#8220;','"',content)
-    content = re.sub('&#8221;','"',content)
-    content = re.sub('&#8230;','...',content)
-    # next two lines remove HTML tags from the summary
-    clean = re.compile('<.*?>') 
-    content = re.sub(clean,'',content)
-#    source = line[10]
-#    if source : myprint("%s : %s (%s) %s; %d " % ( __red(source) ,__blue(__bold(title)), author , time.ctime(itemtime), weight))
-    entries.append( { 'url' : url, 'itemtime' : itemtime, 'title' : title, 'author' : author, 'content' : content, 'weight' : weight, 'source' : source } )
+with phase('query'):
+    # the unread items come from the index on them; with --rank every point of weight of the source counts as
+    # --rank hours more recent, and as that depends on --rank, SQLite sorts the items when we query them
+    order = 'item.time + coalesce(source.weight,5) * %d' % ( args.rank * 3600 ) if args.rank else 'item.time'
+    cur.execute( "SELECT item.url, item.sourceid, item.time, item.readtime, item.addtime, item.title, item.author, item.description, coalesce(item.cluster,item.id) FROM item LEFT JOIN source ON source.id = item.sourceid WHERE item.readtime = 0 AND item.saved = %d AND coalesce(source.weight,5) >= %d AND coalesce(source.weight,5) <= %d ORDER BY %s %s" % ( saved , minweight, maxweight, order, sortorder ) )
+    entries = itemsfromrows(cur.fetchall())
+    # the items of every source, and where every item is among those of its source, so j only has to switch lists
+    bysource = {}
+    sourcepos = []
+    for entry in entries:
+        sourcepos.append(len(bysource.setdefault(entry.source,[])))
+        bysource[entry.source].append(entry)
 
 myprint("%d entries" % len(entries))
+if args.prefetch and not args.readonly:
+    # the articles of the next items are fetched while we read; as the thread doesn't hold anything we need,
+    # it can simply be stopped when we quit
+    threading.Thread(target=prefetcharticles,args=([ e.url for e in entries[:args.prefetch] ],),daemon=True).start()
 counter = 0
-url = ''
 while ( counter >= 0 and counter < len(entries) ):
-    def printline(source,weight,title,author,itemtime):
-        myprint("%s (%s): %s%s %s " % ( __red(source) , __magenta(str(weight)),__blue(__bold(title)), author , time.ctime(itemtime)))
-    prevurl = url # stores the previous URL
-    url = entries[counter]['url']
-    itemtime = entries[counter]['itemtime']
-    title = entries[counter]['title']
-    match = re.search('<a [^>]*>([^<]*)</a>',title)
-    if match: title = match.group(1)
-    author = entries[counter]['author']
+    def printline(source,weight,title,author,itemtime,others=()):
+        also = __magenta(' also in %d other source%s' % ( len(others), 's' if len(others) > 1 else '' )) if others else ''
+        myprint("%s (%s): %s%s %s%s " % ( __red(source) , __magenta(str(weight)),__blue(__bold(title)), author , time.ctime(itemtime), also))
+    url, source, itemtime, title, author, content, weight, others = entries[counter]
     if author: author = ' (' + author + ')'
-    content = entries[counter]['content']
-    weight = entries[counter]['weight']
-    source = entries[counter]['source']
     notnext = 1
-    printline(source,weight,title,author,itemtime)
+    printline(source,weight,title,author,itemtime,others)
     while (notnext):
         key = readchar.readchar().lower()
         if key == '?' or key == 'h':
@@ -1042,23 +2190,22 @@ while ( counter >= 0 and counter < len(entries) ):
             continue
         if key == 'j':
             # just show entries from this source; something I often find helpful
-            entries = ( entries[:counter-1 ] if counter >0 else [] ) + [ x for x in entries[counter:] if x['source'] == source ]
-            myprint("The remaining %s entries are all from %s" % (__red(str(len(entries)-counter)) , __red(source)))
+            if entries is not bysource[source]:
+                counter = sourcepos[counter]
+                entries = bysource[source]
+            myprint("The remaining %s entries are all from %s" % (__red(str(len(entries)-counter-1)) , __red(source)))
             myprint("%s (%s): %s%s %s " % ( __red(source) , __magenta(str(weight)),__blue(__bold(title)), author , time.ctime(itemtime)))
             continue
         if key == 'b':
             if bookmark( url ):
-                try:
-                    cur.execute('UPDATE item SET readtime = %d WHERE url = "%s"' % ( int(time.time()) , url ) )
-                    conn.commit()
-                except:
-                    logging.warning('Failed to mark %s as read' % url )
+                for u in ( url, ) + others:
+                    setstate('UPDATE item SET readtime = ? WHERE url = ?', int(time.time()), u )
                 myprint('')
                 notnext = 0
                 counter = counter + 1
             else:
                 myprint('')
-                printline(source,weight,title,author,itemtime)
+                printline(source,weight,title,author,itemtime,others)
             continue
         if key == '5':
             for c in range(5):
@@ -1066,8 +2213,8 @@ while ( counter >= 0 and counter < len(entries) ):
                 time.sleep(.3)
                 counter = counter + 1
                 if counter >= len(entries): break
-                url = entries[counter]['url']
-                if c < 4: printline(entries[counter]['source'],entries[counter]['weight'],entries[counter]['title'],entries[counter]['author'],entries[counter]['itemtime'])
+                url = entries[counter].url
+                if c < 4: printline(entries[counter].source,entries[counter].weight,entries[counter].title,entries[counter].author,entries[counter].time,entries[counter].others)
             notnext = 0
             continue
         if key == '0':
@@ -1076,8 +2223,8 @@ while ( counter >= 0 and counter < len(entries) ):
                 time.sleep(.3)
                 counter = counter + 1
                 if counter >= len(entries): break
-                url = entries[counter]['url']
-                if c < 9: printline(entries[counter]['source'],entries[counter]['weight'],entries[counter]['title'],entries[counter]['author'],entries[counter]['itemtime'])
+                url = entries[counter].url
+                if c < 9: printline(entries[counter].source,entries[counter].weight,entries[counter].title,entries[counter].author,entries[counter].time,entries[counter].others)
             notnext = 0
             continue
         if key == 'o':
@@ -1088,27 +2235,17 @@ while ( counter >= 0 and counter < len(entries) ):
             counter = counter + 1
             continue
         if key == 'p':
-            try:
-                try:
-                    cur.execute('UPDATE item SET readtime = 0 WHERE url = "%s"' % prevurl )
-                    conn.commit()
-                except:
-                    logging.warning("Can't mark %s as unread" % prevurl)
-            except:
-                logging.warning("Can't mark '%s' (%s) as unread" % ( title , prevurl ) )
+            # the item before this one in the list we go through, which after j is that of the source, and the
+            # near-duplicates we marked with it
+            if counter > 0:
+                for u in ( entries[counter-1].url, ) + entries[counter-1].others:
+                    setstate('UPDATE item SET readtime = 0 WHERE url = ?', u )
             notnext = 0
             counter = counter - 1
             continue
         if key == 'r':
-            try:
-                now = int(time.time())
-                try:
-                    cur.execute('UPDATE item SET readtime = %d WHERE url = "%s"' % ( now , url ) )
-                    conn.commit()
-                except:
-                    logging.warning("Can't mark %s as read" % url)
-            except:
-                logging.warning("Can't mark '%s' (%s) as read" % ( title , url ) )
+            for u in ( url, ) + others:
+                setstate('UPDATE item SET readtime = ? WHERE url = ?', int(time.time()), u )
             notnext = 0
             counter = counter + 1
             continue
@@ -1118,19 +2255,19 @@ while ( counter >= 0 and counter < len(entries) ):
         if key == 'q':
             quit()
         if key == 's':
-            myprint("\n" + content + "\n")
-            printline(source,weight,title,author,itemtime)
+            # the full article if it has been fetched, the summary in the feed otherwise
+            article = getarticle(url)
+            myprint("\n" + ( article if article else terminaltext(content) ) + "\n")
+            printline(source,weight,title,author,itemtime,others)
         if key == 'w':
             os.system('w3m %s' % url )
             continue
         if key == '!':
-            try:
-                cur.execute('UPDATE item SET saved = 1 WHERE url = "%s"' % url )
-                conn.commit()
-                notnext = 0
-                counter = counter + 1
-            except:
-                logging.warning('Failed to mark %s as read' % url )
+            setstate('UPDATE item SET saved = 1 WHERE url = ?', url )
+            for u in others:
+                setstate('UPDATE item SET readtime = ? WHERE url = ?', int(time.time()), u )
+            notnext = 0
+            counter = counter + 1
             continue
 
 